@@ -0,0 +1,221 @@
+import json
+import os
+import random
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+METRICS_JSON_PATH = "api_metrics.json"
+METRICS_PROMETHEUS_PATH = "api_metrics.prom"
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+PERCENTILES = [50, 95, 99]
+# Latencies kept per endpoint to compute the percentiles, a uniform sample of all of them
+LATENCY_SAMPLE_SIZE = 10000
+
+# Source page the requests made in this context are made for
+current_page = ContextVar("current_page", default=None)
+
+
+@contextmanager
+def for_page(source_id):
+    """
+    Attribute the requests made inside the block to the source page source_id.
+    Threads started inside inherit it only if they run in a copy of the
+    context: executor.submit(contextvars.copy_context().run, function, ...).
+    """
+    token = current_page.set(source_id)
+    try:
+        yield
+    finally:
+        current_page.reset(token)
+
+
+def json_size(value):
+    """
+    Size of a request or response in bytes. File contents, e.g. the parts
+    sent by file_uploads.send, count for their length: serializing them
+    would copy the whole file into a string several times its size.
+    """
+    contents = []
+
+    def without_contents(item):
+        if isinstance(item, (bytes, bytearray, memoryview)):
+            contents.append(len(item))
+            return None
+        if hasattr(item, "read"):
+            try:
+                contents.append(os.fstat(item.fileno()).st_size)
+            except (AttributeError, OSError, ValueError):
+                pass
+            return None
+        if isinstance(item, dict):
+            return {key: without_contents(nested) for key, nested in item.items()}
+        if isinstance(item, (list, tuple)):
+            return [without_contents(nested) for nested in item]
+        return item
+    return len(json.dumps(without_contents(value), ensure_ascii=False, default=str).encode()) + sum(contents)
+
+
+def percentile(values, rank):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    index = max(0, -(-len(values) * rank // 100) - 1)
+    return values[int(index)]
+
+
+class ApiMetrics:
+    """
+    Record of every request sent to the API: endpoint, status, retry number,
+    latency, request and response sizes and the source page it was made for.
+    Aggregated as it goes, so a long run does not keep one entry per request:
+    latencies are kept as histogram bucket counts, and percentiles computed
+    from a sample of at most LATENCY_SAMPLE_SIZE of them per endpoint.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.latency_seconds = Counter()
+        self.latency_buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.latency_samples = defaultdict(list)
+        self._random = random.Random()
+        self.statuses = defaultdict(Counter)
+        self.retries = Counter()
+        self.request_bytes = Counter()
+        self.response_bytes = Counter()
+        self.page_requests = Counter()
+        self.migrated_pages = set()
+
+    def record(self, endpoint, status, retry, latency, request_bytes, response_bytes):
+        page = current_page.get()
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.latency_seconds[endpoint] += latency
+            buckets = self.latency_buckets[endpoint]
+            for i, bucket in enumerate(LATENCY_BUCKETS):
+                if latency <= bucket:
+                    buckets[i] += 1
+            # Reservoir sampling: each latency of the endpoint has the same chance to be in the sample
+            samples = self.latency_samples[endpoint]
+            if len(samples) < LATENCY_SAMPLE_SIZE:
+                samples.append(latency)
+            else:
+                index = self._random.randrange(self.requests[endpoint])
+                if index < LATENCY_SAMPLE_SIZE:
+                    samples[index] = latency
+            self.statuses[endpoint][str(status)] += 1
+            if retry:
+                self.retries[endpoint] += 1
+            self.request_bytes[endpoint] += request_bytes
+            self.response_bytes[endpoint] += response_bytes
+            if page is not None:
+                self.page_requests[page] += 1
+
+    def page_migrated(self, source_id):
+        with self._lock:
+            self.migrated_pages.add(source_id)
+
+    def report(self):
+        with self._lock:
+            endpoints = {}
+            for endpoint, samples in sorted(self.latency_samples.items()):
+                latencies = sorted(samples)
+                endpoints[endpoint] = {
+                    "requests": self.requests[endpoint],
+                    "statuses": dict(self.statuses[endpoint]),
+                    "retries": self.retries[endpoint],
+                    "request_bytes": self.request_bytes[endpoint],
+                    "response_bytes": self.response_bytes[endpoint],
+                    "latency_seconds": self.latency_seconds[endpoint],
+                    **{f"p{rank}": percentile(latencies, rank) for rank in PERCENTILES},
+                }
+            migrated = [self.page_requests[page] for page in self.migrated_pages]
+        total = sum(endpoint["requests"] for endpoint in endpoints.values())
+        return {
+            "totals": {
+                "requests": total,
+                "errors": sum(count for endpoint in endpoints.values()
+                              for status, count in endpoint["statuses"].items() if status != "200"),
+                "retries": sum(endpoint["retries"] for endpoint in endpoints.values()),
+                "request_bytes": sum(endpoint["request_bytes"] for endpoint in endpoints.values()),
+                "response_bytes": sum(endpoint["response_bytes"] for endpoint in endpoints.values()),
+                "latency_seconds": sum(endpoint["latency_seconds"] for endpoint in endpoints.values()),
+            },
+            "endpoints": endpoints,
+            "pages": {
+                "migrated": len(migrated),
+                "requests_per_page": sum(migrated) / len(migrated) if migrated else None,
+                "max_requests_per_page": max(migrated, default=None),
+                # Requests not made for a page: database queries, people index...
+                "unattributed_requests": total - sum(self.page_requests.values()),
+            },
+        }
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = [
+            "# HELP notion_requests_total Requests sent to the Notion API.",
+            "# TYPE notion_requests_total counter",
+        ]
+        with self._lock:
+            for endpoint, statuses in sorted(self.statuses.items()):
+                for status, count in sorted(statuses.items()):
+                    lines.append(
+                        f'notion_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            lines += ["# HELP notion_request_retries_total Requests that were retries of a failed one.",
+                      "# TYPE notion_request_retries_total counter"]
+            for endpoint, count in sorted(self.retries.items()):
+                lines.append(f'notion_request_retries_total{{endpoint="{endpoint}"}} {count}')
+            lines += ["# HELP notion_request_bytes_total JSON bytes sent and received.",
+                      "# TYPE notion_request_bytes_total counter"]
+            for endpoint in sorted(self.requests):
+                lines.append(
+                    f'notion_request_bytes_total{{endpoint="{endpoint}",direction="request"}} '
+                    f'{self.request_bytes[endpoint]}')
+                lines.append(
+                    f'notion_request_bytes_total{{endpoint="{endpoint}",direction="response"}} '
+                    f'{self.response_bytes[endpoint]}')
+            lines += ["# HELP notion_request_duration_seconds Latency of the requests.",
+                      "# TYPE notion_request_duration_seconds histogram"]
+            for endpoint, count in sorted(self.requests.items()):
+                for bucket, bucket_count in zip(LATENCY_BUCKETS, self.latency_buckets[endpoint]):
+                    lines.append(
+                        f'notion_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bucket}"}} {bucket_count}')
+                lines.append(
+                    f'notion_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {count}')
+                lines.append(
+                    f'notion_request_duration_seconds_sum{{endpoint="{endpoint}"}} {self.latency_seconds[endpoint]}')
+                lines.append(
+                    f'notion_request_duration_seconds_count{{endpoint="{endpoint}"}} {count}')
+        pages = self.report()["pages"]
+        lines += ["# HELP notion_migrated_pages Pages migrated by the run.",
+                  "# TYPE notion_migrated_pages gauge",
+                  f"notion_migrated_pages {pages['migrated']}",
+                  "# HELP notion_requests_per_page Average requests made for a migrated page.",
+                  "# TYPE notion_requests_per_page gauge",
+                  f"notion_requests_per_page {pages['requests_per_page'] or 0}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=METRICS_JSON_PATH, prometheus_path=METRICS_PROMETHEUS_PATH):
+        with open(json_path, "w") as report:
+            json.dump(self.report(), report, indent=2)
+        with open(prometheus_path, "w") as report:
+            report.write(self.prometheus())
+
+    def summary(self):
+        """Per endpoint table of the report, for the end of a run."""
+        report = self.report()
+        lines = [f"{'endpoint':<24} {'requests':>9} {'retries':>8} {'p50 (s)':>8} "
+                 f"{'p95 (s)':>8} {'p99 (s)':>8} {'total (s)':>10}"]
+        for endpoint, stats in report["endpoints"].items():
+            lines.append(
+                f"{endpoint:<24} {stats['requests']:>9} {stats['retries']:>8} {stats['p50']:>8.3f} "
+                f"{stats['p95']:>8.3f} {stats['p99']:>8.3f} {stats['latency_seconds']:>10.1f}")
+        pages = report["pages"]
+        if pages["migrated"]:
+            lines.append(f"{pages['requests_per_page']:.1f} requests per migrated page "
+                         f"({pages['migrated']} pages, at most {pages['max_requests_per_page']})")
+        return "\n".join(lines)
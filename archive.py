@@ -0,0 +1,110 @@
+import gzip
+import json
+import logging
+import os
+
+# Keys of source blocks that only describe the source workspace
+SOURCE_ONLY_KEYS = ["parent", "created_time", "created_by", "last_edited_by",
+                    "last_edited_time", "archived", "in_trash", "request_id"]
+# Keys of the source page kept in the archive, enough to build the target page
+PAGE_KEYS = ["id", "last_edited_time", "properties"]
+
+
+def open_archive(path, mode):
+    """Open an archive as text, gzip compressed when path ends with .gz."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def sanitize_tree(blocks):
+    """Drop the source only keys of every block of a tree, in place."""
+    for block in blocks:
+        for key in SOURCE_ONLY_KEYS:
+            block.pop(key, None)
+        content = block.get(block.get("type"))
+        if isinstance(content, dict) and content.get("children"):
+            sanitize_tree(content["children"])
+    return blocks
+
+
+def read_archive(path):
+    """
+    Stream the records of an archive, one page at a time: {"page": ..., "blocks": [...]}.
+    Records cut short by an interrupted export are skipped with a warning.
+    """
+    try:
+        with open_archive(path, "r") as archive:
+            for number, line in enumerate(archive, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping incomplete record at line {number} of {path}")
+    except EOFError:
+        logging.warning(f"Archive {path} ends with an incomplete record")
+
+
+def read_latest_records(path):
+    """
+    Stream the records of an archive, keeping only the last one of a page
+    exported more than once. The first pass only keeps the page ids in memory.
+    """
+    latest = {}
+    for position, record in enumerate(read_archive(path)):
+        latest[record["page"]["id"]] = position
+    for position, record in enumerate(read_archive(path)):
+        if latest[record["page"]["id"]] == position:
+            yield record
+
+
+class ArchiveWriter:
+    """
+    Append-only archive of source pages, one JSON record per line: the page
+    (id, last_edited_time, properties) and its sanitized block tree.
+    Pages already archived with the same last_edited_time are known on
+    opening, so an interrupted export continues where it stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.archived = {}
+        if os.path.exists(path):
+            for record in read_archive(path):
+                self.archived[record["page"]["id"]] = record["page"].get("last_edited_time")
+            self._check_end(path)
+        self._file = open_archive(path, "a")
+
+    @staticmethod
+    def _check_end(path):
+        if path.endswith(".gz"):
+            # Records appended after a truncated gzip stream could never be read
+            try:
+                with gzip.open(path) as archive:
+                    archive.seek(0, os.SEEK_END)
+            except EOFError:
+                raise ValueError(f"{path} is truncated, export to a new archive")
+            return
+        with open(path, "rb+") as archive:
+            if archive.seek(0, os.SEEK_END) == 0:
+                return
+            archive.seek(-1, os.SEEK_END)
+            if archive.read(1) != b"\n":
+                # End the record cut short so the next one starts on its own line
+                archive.write(b"\n")
+
+    def is_archived(self, doc):
+        return self.archived.get(doc.get("id"), False) == doc.get("last_edited_time")
+
+    def write(self, exported):
+        doc, blocks = exported
+        record = {"page": {key: doc.get(key) for key in PAGE_KEYS},
+                  "blocks": sanitize_tree(blocks)}
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.flush()
+        self.archived[doc.get("id")] = doc.get("last_edited_time")
+        return doc.get("id")
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,170 @@
+"""
+Benchmark the migration of main.py against the local Notion emulator.
+
+Synthetic workspaces are generated from the shapes of page.json (the blocks of
+a real Doc tech page) and prop.json (its properties), then migrated end to end.
+Reports requests per page, wall time, peak memory and the time the same
+requests would take at Notion's average rate limit.
+
+    python benchmark.py --pages 10 50 --depth 2 6 --latency 0.05
+"""
+import argparse
+import contextlib
+import copy
+import io
+import json
+import random
+import time
+import tracemalloc
+
+import main as migration
+from api_metrics import ApiMetrics
+from fake_notion import FakeNotion
+from notion_api import RateLimitedClient, RateLimiter, REQUESTS_PER_SECOND
+from people_index import PeopleIndex, PEOPLE_DATABASE_ID, EMAIL_PROPERTY
+
+SAMPLE_PAGE = "page.json"
+SAMPLE_PROPERTIES = "prop.json"
+PEOPLE_COUNT = 50
+
+
+def text(content):
+    return [{"type": "text", "text": {"content": content, "link": None},
+             "plain_text": content, "href": None}]
+
+
+def outline(rng, depth, prefix="item"):
+    """Nested bulleted list, depth levels deep."""
+    items = []
+    for i in range(rng.randint(1, 3)):
+        item = {"object": "block", "type": "bulleted_list_item",
+                "bulleted_list_item": {"rich_text": text(f"{prefix}.{i}")}}
+        if depth > 1:
+            item["bulleted_list_item"]["children"] = outline(
+                rng, depth - 1, f"{prefix}.{i}")
+        items.append(item)
+    return items
+
+
+def synthetic_blocks(rng, template, depth):
+    """Copy of the sample page with children generated for its nested blocks."""
+    blocks = copy.deepcopy(template)
+    for block in blocks:
+        block.pop("id", None)
+        if not block.get("has_children"):
+            continue
+        block_type = block["type"]
+        if block_type == "table":
+            width = block["table"].get("table_width", 1)
+            block["table"]["children"] = [
+                {"object": "block", "type": "table_row",
+                 "table_row": {"cells": [text(f"cell {row}.{cell}") for cell in range(width)]}}
+                for row in range(rng.randint(2, 8))]
+        else:
+            block[block_type]["children"] = outline(rng, depth - 1)
+    if rng.random() < 0.3:
+        blocks.append({"object": "block", "type": "code",
+                       "code": {"rich_text": text("x = 1\n" * 800), "language": "python"}})
+    if rng.random() < 0.3:
+        blocks.append({"object": "block", "type": "toggle",
+                       "toggle": {"rich_text": text("Details"), "children": outline(rng, depth)}})
+    return blocks
+
+
+def synthetic_properties(template, name, email):
+    properties = copy.deepcopy(template)
+    properties["Name"]["title"] = text(name)
+    properties["Created By"]["created_by"]["person"] = {"email": email}
+    return properties
+
+
+def build_workspace(fake, rng, pages, depth):
+    with open(SAMPLE_PAGE) as sample:
+        page_template = json.load(sample)
+    with open(SAMPLE_PROPERTIES) as sample:
+        properties_template = json.load(sample)
+    emails = [f"person{i}@theodo.com" for i in range(PEOPLE_COUNT)]
+    fake.add_database(PEOPLE_DATABASE_ID)
+    for email in emails:
+        fake.add_page(PEOPLE_DATABASE_ID, {
+            "Name": {"type": "title", "title": text(email)},
+            EMAIL_PROPERTY: {"type": "rich_text", "rich_text": text(email)},
+        })
+    fake.add_database(migration.SOURCE_DATABASE_ID)
+    fake.add_database(migration.TARGET_DATABASE_ID)
+    for i in range(pages):
+        fake.add_page(migration.SOURCE_DATABASE_ID,
+                      synthetic_properties(properties_template, f"Doc {i}", rng.choice(emails)),
+                      synthetic_blocks(rng, page_template, depth))
+    # Seeding is not part of the measure
+    fake.requests.clear()
+
+
+def run_scenario(pages, depth, latency=0, rate_limit_probability=0, seed=0):
+    rng = random.Random(seed)
+    fake = FakeNotion(latency=latency, rate_limit_probability=rate_limit_probability,
+                      retry_after=0, seed=seed)
+    build_workspace(fake, rng, pages, depth)
+    # The benchmark measures the migration itself, not the client side throttling
+    migration.metrics = ApiMetrics()
+    migration.notion = RateLimitedClient(fake, limiter=RateLimiter(rate=10 ** 6, burst=10 ** 6),
+                                         metrics=migration.metrics)
+    migration.cache = None
+    migration.journal = None
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        migration.people = PeopleIndex.load(migration.notion)
+        written = migration.migrate(migration.query_source_pages())
+    wall_time = time.perf_counter() - started
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    requests = fake.total_requests()
+    return {
+        "pages": pages,
+        "depth": depth,
+        "latency": latency,
+        "rate_limit_probability": rate_limit_probability,
+        "pages_written": len(written),
+        "requests": requests,
+        "requests_per_page": requests / pages if pages else 0,
+        "requests_by_endpoint": dict(fake.requests),
+        "endpoints": migration.metrics.report()["endpoints"],
+        "wall_time": wall_time,
+        "peak_memory_bytes": peak_memory,
+        "rate_limited_duration": requests / REQUESTS_PER_SECOND,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--depth", type=int, nargs="+", default=[2, 6],
+                        help="nesting depth of the generated outlines")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds added to every emulated request")
+    parser.add_argument("--rate-limit-probability", type=float, default=0,
+                        help="share of requests answered with rate_limited")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = []
+    print(f"{'pages':>6} {'depth':>6} {'requests':>9} {'req/page':>9} "
+          f"{'wall (s)':>9} {'peak MB':>8} {'at 3 req/s (s)':>15}")
+    for pages in args.pages:
+        for depth in args.depth:
+            result = run_scenario(pages, depth, args.latency,
+                                  args.rate_limit_probability, args.seed)
+            results.append(result)
+            print(f"{pages:>6} {depth:>6} {result['requests']:>9} "
+                  f"{result['requests_per_page']:>9.1f} {result['wall_time']:>9.2f} "
+                  f"{result['peak_memory_bytes'] / 1e6:>8.1f} {result['rate_limited_duration']:>15.0f}")
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
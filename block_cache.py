@@ -0,0 +1,72 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+CACHE_PATH = ".notion_cache.sqlite"
+# Least recently used trees are evicted above this size (compressed bytes)
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+class BlockCache:
+    """
+    On-disk cache of fetched block trees, stored as compressed JSON in SQLite.
+    An entry holds the whole tree of a page and is only served while the page
+    still has the last_edited_time it was stored with.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS trees ("
+            "block_id TEXT PRIMARY KEY, last_edited_time TEXT, "
+            "data BLOB, size INTEGER, accessed REAL)")
+        self._db.commit()
+
+    def get(self, block_id, last_edited_time):
+        """Return the cached children of block_id, or None if missing or outdated."""
+        if not block_id or not last_edited_time:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM trees WHERE block_id = ? AND last_edited_time = ?",
+                (block_id, last_edited_time)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                "UPDATE trees SET accessed = ? WHERE block_id = ?", (time.time(), block_id))
+            self._db.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, block_id, last_edited_time, children):
+        if not block_id or not last_edited_time:
+            return
+        data = zlib.compress(json.dumps(children).encode())
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO trees VALUES (?, ?, ?, ?, ?)",
+                (block_id, last_edited_time, data, len(data), time.time()))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM trees").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for block_id, size in self._db.execute(
+                "SELECT block_id, size FROM trees ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM trees WHERE block_id = ?", (block_id,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,390 @@
+import copy
+import itertools
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
+from notion_client import APIErrorCode, APIResponseError
+from notion_client.api_endpoints import Endpoint
+
+from packer import MAX_BLOCKS_PER_PAGE, MAX_BLOCKS_PER_REQUEST
+
+# Largest page_size accepted by the paginated endpoints
+MAX_PAGE_SIZE = 100
+MAX_RICH_TEXT_LENGTH = 2000
+# Block types the API returns but refuses to create
+READ_ONLY_BLOCK_TYPES = {"link_preview", "unsupported", "child_page", "child_database"}
+# Largest part of a file upload, and smallest part of a multi part upload but the last
+MAX_UPLOAD_PART_BYTES = 20 * 1024 * 1024
+MIN_UPLOAD_PART_BYTES = 5 * 1024 * 1024
+BLOCK_SERVER_KEYS = {"object", "id", "parent", "created_time", "created_by",
+                     "last_edited_time", "last_edited_by", "has_children",
+                     "archived", "in_trash", "type"}
+
+
+def api_error(code, status, message, headers=None):
+    """Build the APIResponseError notion_client raises for an error response."""
+    headers = httpx.Headers(headers or {})
+    try:
+        return APIResponseError(code=code, status=status, message=message,
+                                headers=headers, raw_body_text=message)
+    except TypeError:
+        # notion-client 2.x builds its errors from the httpx response
+        response = httpx.Response(status, headers=headers, text=message)
+        return APIResponseError(response, message, code)
+
+
+def validation_error(message):
+    return api_error(APIErrorCode.ValidationError.value, 400, message)
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class FakeNotion:
+    """
+    In-process stand-in for notion_client.Client, covering the endpoints the
+    migration scripts use: databases.query, pages.create/retrieve/update,
+    blocks.retrieve/delete, blocks.children.list/append and
+    file_uploads.create/send/complete/retrieve.
+    It paginates like the API, rejects payloads over the request limits
+    (array size, nesting, block count, rich text length) with the same
+    validation_error, and can add latency and inject rate_limited errors.
+    requests counts the calls per endpoint.
+    """
+
+    def __init__(self, latency=0, rate_limit_probability=0, retry_after=1, seed=None):
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.objects = {}
+        self.children = {}
+        self.uploads = {}
+        self.requests = Counter()
+        self._order = itertools.count()
+        self._lock = threading.RLock()
+        self.databases = DatabasesEndpoint(self)
+        self.pages = PagesEndpoint(self)
+        self.blocks = BlocksEndpoint(self)
+        self.file_uploads = FileUploadsEndpoint(self)
+
+    def _request(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+            limited = self.random.random() < self.rate_limit_probability
+        if self.latency:
+            time.sleep(self.latency)
+        if limited:
+            raise api_error(APIErrorCode.RateLimited.value, 429, "Rate limited",
+                            {"retry-after": str(self.retry_after)})
+
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def _get(self, object_id):
+        item = self.objects.get(object_id)
+        if item is None or item.get("archived"):
+            raise api_error(APIErrorCode.ObjectNotFound.value, 404,
+                            f"Could not find object with ID: {object_id}.")
+        return item
+
+    def _paginate(self, items, start_cursor=None, page_size=MAX_PAGE_SIZE):
+        page_size = min(page_size or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        start = int(start_cursor) if start_cursor else 0
+        end = start + page_size
+        return {
+            "object": "list",
+            "results": [copy.deepcopy(item) for item in items[start:end]],
+            "has_more": end < len(items),
+            "next_cursor": str(end) if end < len(items) else None,
+        }
+
+    # Seeding, not counted as requests
+
+    def add_database(self, database_id=None):
+        database_id = database_id or str(uuid.uuid4())
+        self.objects[database_id] = {"object": "database", "id": database_id}
+        self.children.setdefault(database_id, [])
+        return database_id
+
+    def add_page(self, database_id, properties, children=(), last_edited_time=None):
+        """Add a page to a database without validating or counting it, as source data."""
+        page = self._new_page({"database_id": database_id}, properties)
+        if last_edited_time:
+            page["last_edited_time"] = last_edited_time
+        self._insert_blocks(page["id"], "page_id", copy.deepcopy(list(children)))
+        return page["id"]
+
+    # Storage
+
+    def _new_page(self, parent, properties):
+        timestamp = now()
+        page = {
+            "object": "page",
+            "id": str(uuid.uuid4()),
+            "created_time": timestamp,
+            "last_edited_time": timestamp,
+            "parent": {"type": "database_id", **parent},
+            "archived": False,
+            "properties": copy.deepcopy(properties),
+            "_order": next(self._order),
+        }
+        self.objects[page["id"]] = page
+        self.children.setdefault(page["id"], [])
+        database_id = parent.get("database_id")
+        if database_id:
+            if database_id not in self.objects:
+                self.add_database(database_id)
+            self.children[database_id].append(page["id"])
+        return page
+
+    def _insert_blocks(self, parent_id, parent_type, blocks):
+        created = []
+        timestamp = now()
+        for block in blocks:
+            block_type = block.get("type") or next(
+                key for key in block if key not in BLOCK_SERVER_KEYS)
+            content = dict(block.get(block_type) or {})
+            children = content.pop("children", None) or []
+            stored = {
+                "object": "block",
+                "id": str(uuid.uuid4()),
+                "parent": {"type": parent_type, parent_type: parent_id},
+                "created_time": timestamp,
+                "last_edited_time": block.get("last_edited_time", timestamp),
+                "has_children": False,
+                "archived": False,
+                "type": block_type,
+                block_type: content,
+            }
+            self.objects[stored["id"]] = stored
+            self.children[parent_id].append(stored["id"])
+            self.children[stored["id"]] = []
+            if children:
+                self._insert_blocks(stored["id"], "block_id", children)
+            created.append(stored)
+        if parent_id in self.objects and self.objects[parent_id]["object"] == "block":
+            self.objects[parent_id]["has_children"] = bool(self._live_children(parent_id))
+        return created
+
+    def _live_children(self, parent_id):
+        return [child_id for child_id in self.children.get(parent_id, [])
+                if not self.objects[child_id].get("archived")]
+
+    # Validation
+
+    def _validate_children(self, children, location="body.children", level=1, counter=None):
+        counter = counter if counter is not None else [0]
+        if len(children) > MAX_BLOCKS_PER_PAGE:
+            raise validation_error(
+                f"{location}.length should be ≤ `{MAX_BLOCKS_PER_PAGE}`, instead was `{len(children)}`.")
+        for i, block in enumerate(children):
+            counter[0] += 1
+            if counter[0] > MAX_BLOCKS_PER_REQUEST:
+                raise validation_error(
+                    f"body.children should contain at most {MAX_BLOCKS_PER_REQUEST} blocks")
+            block_type = block.get("type") or next(
+                (key for key in block if key not in BLOCK_SERVER_KEYS), None)
+            if block_type is None or not isinstance(block.get(block_type), dict):
+                raise validation_error(f"{location}[{i}] should be a block object.")
+            if block_type in READ_ONLY_BLOCK_TYPES:
+                raise validation_error(
+                    f"{location}[{i}].{block_type} is not supported via the API.")
+            if block_type in ("image", "file", "pdf", "video", "audio"):
+                file_upload = block[block_type].get("file_upload")
+                if "external" not in block[block_type] and file_upload is None:
+                    raise validation_error(
+                        f"{location}[{i}].{block_type}.external should be defined.")
+                if file_upload is not None and self.uploads.get(
+                        file_upload.get("id"), {}).get("status") != "uploaded":
+                    raise validation_error(
+                        f"{location}[{i}].{block_type}.file_upload: {file_upload.get('id')} is not uploaded.")
+            content = block[block_type]
+            rich_text = content.get("rich_text", [])
+            if len(rich_text) > MAX_BLOCKS_PER_PAGE:
+                raise validation_error(
+                    f"{location}[{i}].{block_type}.rich_text.length should be ≤ `100`, instead was `{len(rich_text)}`.")
+            for j, text in enumerate(rich_text):
+                text_content = text.get("text", {}).get("content", "")
+                if len(text_content) > MAX_RICH_TEXT_LENGTH:
+                    raise validation_error(
+                        f"{location}[{i}].{block_type}.rich_text[{j}].text.content.length "
+                        f"should be ≤ `{MAX_RICH_TEXT_LENGTH}`, instead was `{len(text_content)}`.")
+            nested = content.get("children")
+            if nested:
+                if level >= 2:
+                    raise validation_error(
+                        f"{location}[{i}].{block_type}.children should be not present, instead was `{nested}`.")
+                self._validate_children(
+                    nested, f"{location}[{i}].{block_type}.children", level + 1, counter)
+
+
+class DatabasesEndpoint(Endpoint):
+    def query(self, database_id, filter=None, start_cursor=None, page_size=None, **kwargs):
+        fake = self.parent
+        fake._request("databases.query")
+        fake._get(database_id)
+        pages = [fake.objects[page_id] for page_id in fake._live_children(database_id)]
+        if filter:
+            pages = [page for page in pages if _matches(page, filter)]
+        pages = sorted(pages, key=lambda page: page["_order"])
+        response = fake._paginate(pages, start_cursor, page_size)
+        for page in response["results"]:
+            page.pop("_order", None)
+        return response
+
+
+def _matches(page, filter):
+    if filter.get("timestamp") == "last_edited_time":
+        since = filter["last_edited_time"].get("on_or_after")
+        return since is None or page["last_edited_time"] >= since
+    prop = page["properties"].get(filter.get("property"), {})
+    contains = filter.get("rich_text", {}).get("contains")
+    if contains is not None:
+        value = "".join(text.get("plain_text", "")
+                        for text in prop.get(prop.get("type"), []) or [])
+        return contains in value
+    return True
+
+
+class PagesEndpoint(Endpoint):
+    def create(self, parent, properties, children=None, **kwargs):
+        fake = self.parent
+        fake._request("pages.create")
+        children = children or []
+        fake._validate_children(children)
+        with fake._lock:
+            page = fake._new_page(parent, properties)
+            fake._insert_blocks(page["id"], "page_id", copy.deepcopy(children))
+        return {key: value for key, value in copy.deepcopy(page).items() if key != "_order"}
+
+    def retrieve(self, page_id, **kwargs):
+        fake = self.parent
+        fake._request("pages.retrieve")
+        page = copy.deepcopy(fake._get(page_id))
+        page.pop("_order", None)
+        return page
+
+    def update(self, page_id, properties=None, archived=None, **kwargs):
+        fake = self.parent
+        fake._request("pages.update")
+        with fake._lock:
+            page = fake._get(page_id)
+            page["properties"].update(copy.deepcopy(properties or {}))
+            if archived is not None:
+                page["archived"] = archived
+            page["last_edited_time"] = now()
+        page = copy.deepcopy(page)
+        page.pop("_order", None)
+        return page
+
+
+class BlocksEndpoint(Endpoint):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.children = BlocksChildrenEndpoint(parent)
+
+    def retrieve(self, block_id, **kwargs):
+        fake = self.parent
+        fake._request("blocks.retrieve")
+        return copy.deepcopy(fake._get(block_id))
+
+    def delete(self, block_id, **kwargs):
+        fake = self.parent
+        fake._request("blocks.delete")
+        with fake._lock:
+            block = fake._get(block_id)
+            block["archived"] = True
+            parent_id = block["parent"].get(block["parent"]["type"])
+            if parent_id in fake.objects and fake.objects[parent_id]["object"] == "block":
+                fake.objects[parent_id]["has_children"] = bool(
+                    fake._live_children(parent_id))
+        return copy.deepcopy(block)
+
+
+class BlocksChildrenEndpoint(Endpoint):
+    def list(self, block_id, start_cursor=None, page_size=None, **kwargs):
+        fake = self.parent
+        fake._request("blocks.children.list")
+        fake._get(block_id)
+        blocks = [fake.objects[child_id] for child_id in fake._live_children(block_id)]
+        return fake._paginate(blocks, start_cursor, page_size)
+
+    def append(self, block_id, children, **kwargs):
+        fake = self.parent
+        fake._request("blocks.children.append")
+        parent = fake._get(block_id)
+        fake._validate_children(children)
+        parent_type = "page_id" if parent["object"] == "page" else "block_id"
+        with fake._lock:
+            created = fake._insert_blocks(block_id, parent_type, copy.deepcopy(children))
+        return {"object": "list", "results": copy.deepcopy(created),
+                "has_more": False, "next_cursor": None}
+
+
+def _public_upload(upload):
+    return {key: value for key, value in upload.items() if key not in ("parts", "content")}
+
+
+class FileUploadsEndpoint(Endpoint):
+    def create(self, mode="single_part", filename=None, content_type=None, number_of_parts=None, **kwargs):
+        fake = self.parent
+        fake._request("file_uploads.create")
+        if mode == "multi_part" and not number_of_parts:
+            raise validation_error("body.number_of_parts should be defined for a multi_part upload.")
+        upload = {"object": "file_upload", "id": str(uuid.uuid4()), "status": "pending",
+                  "filename": filename, "content_type": content_type, "mode": mode,
+                  "number_of_parts": number_of_parts, "content_length": None,
+                  "parts": {}, "content": None}
+        with fake._lock:
+            fake.uploads[upload["id"]] = upload
+        return _public_upload(upload)
+
+    def send(self, file_upload_id, file, part_number=None, **kwargs):
+        fake = self.parent
+        fake._request("file_uploads.send")
+        upload = fake.uploads.get(file_upload_id)
+        if upload is None:
+            raise api_error(APIErrorCode.ObjectNotFound.value, 404,
+                            f"Could not find file upload with ID: {file_upload_id}.")
+        data = file[1] if isinstance(file, tuple) else file
+        data = data.read() if hasattr(data, "read") else data
+        if len(data) > MAX_UPLOAD_PART_BYTES:
+            raise validation_error(f"The file part is larger than {MAX_UPLOAD_PART_BYTES} bytes.")
+        if upload["status"] != "pending":
+            raise validation_error(f"File upload {file_upload_id} is {upload['status']}.")
+        if upload["mode"] == "multi_part":
+            part = int(part_number or 0)
+            if not 1 <= part <= upload["number_of_parts"]:
+                raise validation_error(f"part_number should be between 1 and {upload['number_of_parts']}.")
+            upload["parts"][part] = data
+        else:
+            upload["content"] = data
+            upload["content_length"] = len(data)
+            upload["status"] = "uploaded"
+        return _public_upload(upload)
+
+    def complete(self, file_upload_id, **kwargs):
+        fake = self.parent
+        fake._request("file_uploads.complete")
+        upload = fake.uploads[file_upload_id]
+        parts = [upload["parts"].get(part) for part in range(1, upload["number_of_parts"] + 1)]
+        if upload["mode"] != "multi_part" or any(part is None for part in parts):
+            raise validation_error(f"File upload {file_upload_id} is missing parts.")
+        if any(len(part) < MIN_UPLOAD_PART_BYTES for part in parts[:-1]):
+            raise validation_error(f"Parts but the last must be at least {MIN_UPLOAD_PART_BYTES} bytes.")
+        upload["content"] = b"".join(parts)
+        upload["content_length"] = len(upload["content"])
+        upload["status"] = "uploaded"
+        return _public_upload(upload)
+
+    def retrieve(self, file_upload_id, **kwargs):
+        fake = self.parent
+        fake._request("file_uploads.retrieve")
+        return _public_upload(fake.uploads[file_upload_id])
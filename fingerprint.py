@@ -0,0 +1,214 @@
+import copy
+import hashlib
+import json
+import threading
+
+from notion_client.helpers import iterate_paginated_api
+
+from transform import FILE_BLOCK_TYPES, FILE_WARNING, IMAGE_WARNING
+
+# Keys of a block that describe where and when it was written, not what it holds
+BLOCK_KEYS = ["object", "id", "parent", "type", "has_children", "created_time", "created_by",
+              "last_edited_time", "last_edited_by", "archived", "in_trash", "request_id"]
+# Values the API fills in when a request leaves them out
+DEFAULT_VALUES = {"color": "default", "is_toggleable": False}
+# Where a file comes from changes when it is copied to the target (see rehost.py)
+FILE_SOURCE_KEYS = ["type", "file", "file_upload"]
+
+
+def block_type_of(block):
+    return block.get("type") or next(key for key in block if key not in BLOCK_KEYS)
+
+
+def plain_text(rich_text):
+    return "".join(item.get("plain_text") or (item.get("text") or {}).get("content", "")
+                   for item in rich_text)
+
+
+def normalize_rich_text(rich_text):
+    """
+    Rich text as [type, value, annotations] triples, the same whether it is
+    read from the API or about to be sent: response only keys and default
+    annotations are left out, and neighbour texts of the same style merged.
+    """
+    items = []
+    for item in rich_text:
+        item_type = item.get("type", "text")
+        annotations = {key: value for key, value in (item.get("annotations") or {}).items()
+                       if value not in (False, "default")}
+        if item_type == "text":
+            link = (item["text"].get("link") or {}).get("url")
+            value = [item["text"].get("content", ""), link]
+            if items and items[-1][0] == "text" and items[-1][1][1] == link and items[-1][2] == annotations:
+                items[-1][1][0] += value[0]
+                continue
+        elif item_type == "equation":
+            value = item["equation"].get("expression")
+        else:
+            mention = item.get(item_type) or {}
+            target = mention.get(mention.get("type"))
+            value = [mention.get("type"), target.get("id", target) if isinstance(target, dict) else target]
+        items.append([item_type, value, annotations])
+    return items
+
+
+def hosted_file_kind(block_type, content):
+    """
+    "hosted image" or "hosted file" for a file hosted by Notion and for the
+    warning written in its place, None for other blocks: whether the file
+    was copied depends on the run, not on the source.
+    """
+    if block_type in FILE_BLOCK_TYPES and isinstance(content, dict) and \
+            content.get("type") in ("file", "file_upload"):
+        return "hosted image" if block_type == "image" else "hosted file"
+    if block_type == "paragraph" and isinstance(content, dict):
+        text = plain_text(content.get("rich_text", []))
+        if text in (IMAGE_WARNING, FILE_WARNING):
+            return "hosted image" if text == IMAGE_WARNING else "hosted file"
+    return None
+
+
+def normalize_content(block_type, content):
+    if not isinstance(content, dict):
+        return content
+    normalized = {}
+    for key, value in content.items():
+        if key == "children" or value in (None, [], {}) or DEFAULT_VALUES.get(key) == value:
+            continue
+        if block_type in FILE_BLOCK_TYPES and key in FILE_SOURCE_KEYS:
+            continue
+        if key in ("rich_text", "caption"):
+            value = normalize_rich_text(value)
+        elif key == "cells":
+            value = [normalize_rich_text(cell) for cell in value]
+        normalized[key] = value
+    return normalized
+
+
+def block_hash(block):
+    """Structural hash of a block and its subtree, ids and timestamps left out."""
+    block_type = block_type_of(block)
+    content = block.get(block_type)
+    kind = hosted_file_kind(block_type, content)
+    digest = hashlib.sha256(json.dumps(
+        [kind] if kind else [block_type, normalize_content(block_type, content)],
+        sort_keys=True, ensure_ascii=False).encode())
+    for child in (content.get("children") or []) if isinstance(content, dict) else []:
+        digest.update(block_hash(child).encode())
+    return digest.hexdigest()
+
+
+def tree_hash(blocks):
+    digest = hashlib.sha256()
+    for block in blocks:
+        digest.update(block_hash(block).encode())
+    return digest.hexdigest()
+
+
+def normalize_properties(properties):
+    """Values of title, text, select and relation properties, as sent or as read back."""
+    normalized = {}
+    for name, prop in properties.items():
+        if prop.get("title") or prop.get("rich_text"):
+            normalized[name] = plain_text(prop.get("title") or prop.get("rich_text"))
+        elif prop.get("select"):
+            normalized[name] = prop["select"].get("name")
+        elif prop.get("relation"):
+            normalized[name] = sorted(item["id"].replace("-", "") for item in prop["relation"])
+    return normalized
+
+
+def page_fingerprint(properties, blocks_hash):
+    """Fingerprint of a page: its properties and the hash of its block tree."""
+    return hashlib.sha256(json.dumps(
+        [normalize_properties(properties), blocks_hash], sort_keys=True, ensure_ascii=False
+    ).encode()).hexdigest()
+
+
+def prepared_tree(initial_blocks, excess_blocks, deep_blocks):
+    """
+    The tree a prepared page has once written: a copy of its top level blocks
+    with every deep group appended under the block at its path.
+    """
+    tree = copy.deepcopy(initial_blocks + excess_blocks)
+    for path in sorted(deep_blocks, key=len):
+        siblings = tree
+        for position in path[:-1]:
+            parent = siblings[position]
+            siblings = parent[block_type_of(parent)].setdefault("children", [])
+        parent = siblings[path[-1]]
+        parent[block_type_of(parent)].setdefault("children", []).extend(
+            copy.deepcopy(deep_blocks[path]))
+    return tree
+
+
+def title_of(properties):
+    return next((plain_text(prop["title"]) for prop in properties.values() if "title" in prop), "")
+
+
+class TargetIndex:
+    """
+    Pages already in the target database, indexed by title with one paginated
+    query, to recognise the pages an earlier run wrote without a journal.
+    A page is a duplicate when a target page has the same title, the same
+    values for the properties it would be written with and the same block
+    tree: the tree of a target page is only fetched when its title and
+    properties match, and each target page stands for one source page at most.
+    """
+
+    def __init__(self):
+        self.by_title = {}
+        self.tree_hashes = {}
+        self.claimed = set()
+        self.linked = 0
+        self._lock = threading.Lock()
+
+    def add(self, page):
+        self.by_title.setdefault(title_of(page.get("properties", {})), []).append(page)
+
+    def __len__(self):
+        return sum(len(pages) for pages in self.by_title.values())
+
+    def claim(self, page_id):
+        """Take a target page out of the candidates, e.g. because the journal maps it to a source page."""
+        if page_id is not None:
+            with self._lock:
+                self.claimed.add(page_id)
+
+    def find(self, properties, build_tree, fetch_tree):
+        """
+        Return the id of an unclaimed target page identical to the page that
+        properties and the block tree returned by build_tree() describe, and
+        claim it. build_tree is only called once a target page has the same
+        title and properties, most pages have none. fetch_tree(page_id,
+        last_edited_time) returns the block tree of a target page.
+        """
+        candidates = [page for page in self.by_title.get(title_of(properties), [])
+                      if page["id"] not in self.claimed]
+        fingerprint = None
+        for page in candidates:
+            target_properties = {name: page["properties"].get(name, {}) for name in properties}
+            if normalize_properties(target_properties) != normalize_properties(properties):
+                continue
+            if fingerprint is None:
+                fingerprint = page_fingerprint(properties, tree_hash(build_tree()))
+            if page["id"] not in self.tree_hashes:
+                self.tree_hashes[page["id"]] = tree_hash(
+                    fetch_tree(page["id"], page.get("last_edited_time")))
+            if page_fingerprint(target_properties, self.tree_hashes[page["id"]]) != fingerprint:
+                continue
+            with self._lock:
+                if page["id"] in self.claimed:
+                    continue
+                self.claimed.add(page["id"])
+                self.linked += 1
+            return page["id"]
+        return None
+
+    @classmethod
+    def load(cls, notion, database_id):
+        index = cls()
+        for page in iterate_paginated_api(notion.databases.query, database_id=database_id):
+            index.add(page)
+        print(f"Indexed {len(index)} pages of the target database")
+        return index
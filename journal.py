@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+
+JOURNAL_PATH = "migration_journal.jsonl"
+
+
+class Journal:
+    """
+    Append-only record of a migration, one JSON event per line:
+    - page: the target page created for a source page, with the number of
+      top level blocks sent along with the creation
+    - batch: an append that succeeded, with the ids of the blocks it created
+    - substitute: a block the API rejected, written as a placeholder instead
+    - done: every write of the page went through, for this last_edited_time
+      of the source
+    - reset: the content of the target page was deleted to be written again
+    Replaying the file on startup tells a restarted run which pages to skip and
+    where to resume a page that was only partially written.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.pages = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as journal:
+                for line in journal:
+                    if line.strip():
+                        self._apply(json.loads(line))
+        self._file = open(path, "a")
+
+    def _page(self, source_id):
+        return self.pages.setdefault(
+            source_id, {"target": None, "initial": 0, "batches": {}, "substituted": {},
+                        "done": False, "edited": None})
+
+    def _apply(self, entry):
+        page = self._page(entry["source"])
+        event = entry["event"]
+        if event == "page":
+            page["target"] = entry["target"]
+            page["initial"] = entry.get("initial", 0)
+        elif event == "batch":
+            page["batches"][tuple(entry["key"])] = {
+                tuple(path): block_id for path, block_id in entry["ids"]}
+        elif event == "substitute":
+            page["substituted"][tuple(entry["path"])] = entry["block_type"]
+        elif event == "done":
+            page["done"] = True
+            page["edited"] = entry.get("edited")
+        elif event == "reset":
+            page.update({"initial": 0, "batches": {}, "substituted": {}, "done": False, "edited": None})
+
+    def _write(self, entry):
+        with self._lock:
+            self._apply(entry)
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def is_done(self, source_id):
+        return source_id in self.pages and self.pages[source_id]["done"]
+
+    def is_up_to_date(self, source_id, last_edited_time):
+        """True if the page was fully written from this version of the source."""
+        return self.is_done(source_id) and self.pages[source_id]["edited"] == last_edited_time
+
+    def initial_blocks(self, source_id):
+        """Number of top level blocks written by the creation of the target page."""
+        return self.pages[source_id]["initial"] if source_id in self.pages else 0
+
+    def top_level_blocks(self, source_id):
+        """Number of top level blocks written to the target page, by its creation and by the appends."""
+        if source_id not in self.pages:
+            return 0
+        page = self.pages[source_id]
+        appended = {path for ids in page["batches"].values() for path in ids if len(path) == 1}
+        return page["initial"] + len(appended)
+
+    def target_page(self, source_id):
+        """Id of the target page already created for source_id, if any."""
+        return self.pages[source_id]["target"] if source_id in self.pages else None
+
+    def completed_batch(self, source_id, key):
+        """Return the {path: id} of the blocks created by a completed batch, None if not completed."""
+        if source_id not in self.pages:
+            return None
+        return self.pages[source_id]["batches"].get(tuple(key))
+
+    def record_page(self, source_id, target_id, initial_blocks=0):
+        self._write({"event": "page", "source": source_id,
+                     "target": target_id, "initial": initial_blocks})
+
+    def record_batch(self, source_id, key, ids):
+        self._write({"event": "batch", "source": source_id, "key": list(key),
+                     "ids": [[list(path), block_id] for path, block_id in ids.items()]})
+
+    def record_substitution(self, source_id, path, block_type, error):
+        self._write({"event": "substitute", "source": source_id, "path": list(path),
+                     "block_type": block_type, "error": error})
+
+    def record_done(self, source_id, last_edited_time=None):
+        self._write({"event": "done", "source": source_id, "edited": last_edited_time})
+
+    def record_reset(self, source_id):
+        self._write({"event": "reset", "source": source_id})
+
+    def close(self):
+        self._file.close()
@@ -1,624 +1,895 @@
-from notion_client.helpers import collect_paginated_api
+from notion_client.helpers import collect_paginated_api, iterate_paginated_api
+import argparse
+import copy
+import json
 import os
 import logging
-from notion_client import Client
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextvars import copy_context
+from datetime import datetime, timezone
+from notion_api import create_client, add_transport_arguments, transport_options
+from api_metrics import ApiMetrics, for_page, METRICS_JSON_PATH, METRICS_PROMETHEUS_PATH
+from people_index import PeopleIndex
+from pipeline import run_pipeline, InFlightLimit
+from block_cache import BlockCache, CACHE_PATH
+from transform import prepare_blocks_for_notion, warning_paragraph, MAX_NESTING_DEPTH
+from packer import pack_blocks, block_count
+import preflight
+from planner import Plan, fetch_requests, tree_stats, PLAN_PATH
+from rehost import FileRehoster, hosted_file_blocks, source_of
+from fingerprint import TargetIndex, prepared_tree
+from tracing import Tracer, TRACE_PATH
+import verify as verifier
+from journal import Journal, JOURNAL_PATH
+from archive import ArchiveWriter, read_latest_records
 from notion_client import APIErrorCode, APIResponseError
 
-imagenum = 0
-unsupported_blocks_removed = 0
-
-MAX_CODE_BLOCK_LENGTH = 2000
-MAX_BLOCKS_PER_PAGE = 100
-MAX_NESTING_DEPTH = 2
+# Source tree cache, disabled with --no-cache
+cache = None
+# Journal of completed writes, used to resume an interrupted run
+journal = None
+# Set by --sync: pages already migrated are rewritten when their source changed
+sync_mode = False
+# Notion client, its request metrics and people index, set up by main()
+notion = None
+metrics = None
+people = None
+# Blocks of the pages fetched and not written yet, see migrate()
+in_flight = None
+# Copies the files hosted by the source to the target, disabled with --no-rehost-files
+rehoster = None
+# Pages already in the target database, disabled with --no-dedup
+target_index = None
+# Spans of the phases of every page, enabled with --trace
+tracer = None
+# Source pages some writes of which failed, resumed by the next run
+incomplete_pages = []
+
+# Number of concurrent blocks.children.list calls while fetching a page tree
+FETCH_WORKERS = 8
+# Number of concurrent appends of deep block groups
+APPEND_WORKERS = 4
+# Blocks fetched but not written yet above which no new page is fetched
+MAX_IN_FLIGHT_BLOCKS = 20000
+# Doc tech
+SOURCE_DATABASE_ID = "7c572848e4f04761b659c8f14c6d516e"
+# Test db
+TARGET_DATABASE_ID = "1818f3776f4f80158a6ac3fd054fc9c5"
+# Database the pages are written to, changed with --target-database
+target_database_id = TARGET_DATABASE_ID
+SYNC_STATE_PATH = "sync_state.json"
+
+
+def span(name, **args):
+    """Trace a phase of the current page when tracing is on; yields a dict to attach counts to."""
+    return tracer.span(name, **args) if tracer is not None else nullcontext({})
+
+
+def list_children(block_id):
+    return collect_paginated_api(
+        notion.blocks.children.list, block_id=block_id)
 
 
-def filter_unsupported_blocks(blocks):
+def get_all_children(block_id, last_edited_time=None):
     """
-    Recursively filter out blocks of type 'unsupported' from the block list.
-    Also filters unsupported blocks in nested children.
-    Returns the filtered blocks and count of removed blocks.
+    Fetch the whole block tree under block_id, downloading sibling subtrees
+    concurrently on a pool of FETCH_WORKERS threads.
+    The children of a block are stored in block[type]["children"], the blocks
+    are returned as the API sends them: prepare_blocks_for_notion sanitizes them.
+    When the block cache is enabled, the tree of a page whose last_edited_time
+    did not change since it was stored is read from disk. Nested subtrees are
+    only served as part of their page: editing a deep block changes the
+    last_edited_time of the page, not necessarily of the blocks above it.
     """
-    global unsupported_blocks_removed
+    if cache is not None:
+        cached = cache.get(block_id, last_edited_time)
+        if cached is not None:
+            print("Blocks served from cache")
+            return cached
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        pending = {}
+
+        def expand(children):
+            # Continue recursively if the block has children
+            for block in children:
+                if not block.get("has_children"):
+                    continue
+                future = executor.submit(
+                    copy_context().run, list_children, block.get("id"))
+                pending[future] = block
+            return children
+
+        children = expand(list_children(block_id))
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                parent = pending.pop(future)
+                parent[parent.get("type")]["children"] = expand(future.result())
+    if cache is not None:
+        cache.put(block_id, last_edited_time, children)
+    # Return all children without transforming them (preparation will happen later)
+    return children
 
-    if not isinstance(blocks, list):
-        return blocks
 
-    filtered_blocks = []
+def substitute_block(parent_id, block, path, error, source_id=None):
+    """Append a placeholder paragraph in place of a block the API rejected, return its {path: id}."""
+    block_type = block.get("type") or next(iter(block))
+    print(f"Replacing {block_type} block at path {list(path)} with a placeholder: {error.code}")
+    logging.error(f"Block at path {list(path)} rejected: {error}")
+    response = notion.blocks.children.append(
+        block_id=parent_id,
+        children=[warning_paragraph(
+            f"⚠️ A {block_type} block could not be migrated, go fetch it from the original doc ⚠️")]
+    )
+    if journal is not None and source_id is not None:
+        journal.record_substitution(source_id, path, block_type, str(error))
+    return {path: response.get("results")[0].get("id")}
 
-    for block in blocks:
-        if not isinstance(block, dict):
-            filtered_blocks.append(block)
-            continue
 
-        # Skip blocks with type='unsupported'
-        if block.get("type") == "unsupported":
-            unsupported_blocks_removed += 1
-            continue
+def append_apart(parent_id, block, path, error, source_id=None):
+    """
+    Append a rejected block that holds inline children without them, then
+    its children under it, bisected in turn by append_batch: the invalid
+    block may be one of them. When the block is rejected on its own, it is
+    replaced with a placeholder, children included.
+    """
+    block_type = block.get("type") or next(iter(block))
+    key = path + ("without children",)
+    appended_ids = None
+    if journal is not None and source_id is not None:
+        appended_ids = journal.completed_batch(source_id, key)
+    if appended_ids is None:
+        print(f"{block_type} block at path {list(path)} rejected ({error.code}), appending it without its children")
+        try:
+            response = notion.blocks.children.append(
+                block_id=parent_id,
+                children=[{**block, block_type: {
+                    name: value for name, value in block[block_type].items() if name != "children"}}]
+            )
+        except APIResponseError as block_error:
+            if block_error.code != APIErrorCode.ValidationError.value:
+                raise
+            return substitute_block(parent_id, block, path, block_error, source_id)
+        appended_ids = {path: response.get("results")[0].get("id")}
+        if journal is not None and source_id is not None:
+            journal.record_batch(source_id, key, appended_ids)
+    children = block[block_type]["children"]
+    appended_ids.update(append_batch(appended_ids[path], children, 0, path, source_id))
+    return appended_ids
+
+
+def append_batch(parent_id, batch, first_index, path_prefix, source_id=None, key=None):
+    """
+    Append one batch and return the {path: id} of the blocks it created.
+    A batch the API rejects as invalid is split in halves that are appended
+    in turn, narrowing down to the offending blocks, which are replaced with a
+    placeholder: one bad block costs about 2 * log2(len(batch)) more requests
+    and every other block is written. A block rejected with inline children
+    is narrowed down further, see append_apart. Halves are journaled under
+    the range of indexes they cover, so a resumed run does not append them twice.
+    """
+    key = key or path_prefix + (f"{first_index}-{first_index + len(batch)}",)
+    if journal is not None and source_id is not None:
+        appended_ids = journal.completed_batch(source_id, key)
+        if appended_ids is not None:
+            return appended_ids
+    try:
+        response = notion.blocks.children.append(
+            block_id=parent_id,
+            children=batch
+        )
+    except APIResponseError as error:
+        if error.code != APIErrorCode.ValidationError.value:
+            raise
+        if len(batch) == 1:
+            block_type = batch[0].get("type") or next(iter(batch[0]))
+            if (batch[0].get(block_type) or {}).get("children"):
+                appended_ids = append_apart(
+                    parent_id, batch[0], path_prefix + (first_index,), error, source_id)
+            else:
+                appended_ids = substitute_block(
+                    parent_id, batch[0], path_prefix + (first_index,), error, source_id)
+        else:
+            middle = len(batch) // 2
+            print(f"{len(batch)} blocks rejected ({error.code}), appending them in halves")
+            appended_ids = append_batch(
+                parent_id, batch[:middle], first_index, path_prefix, source_id)
+            appended_ids.update(append_batch(
+                parent_id, batch[middle:], first_index + middle, path_prefix, source_id))
+    else:
+        appended_ids = {}
+        for offset, created in enumerate(response.get("results", [])):
+            appended_ids[path_prefix + (first_index + offset,)] = created.get("id")
+    if journal is not None and source_id is not None:
+        journal.record_batch(source_id, key, appended_ids)
+    return appended_ids
 
-        # Process nested children recursively
-        block_type = block.get("type")
-        if block.get("has_children") and block_type and block_type in block:
-            if "children" in block[block_type]:
-                block[block_type]["children"] = filter_unsupported_blocks(
-                    block[block_type]["children"])
 
-        # Add the block to the filtered results
-        filtered_blocks.append(block)
+def append_blocks(parent_id, blocks, path_prefix, block_id_map, first_index=0, source_id=None):
+    """
+    Append blocks to parent_id in batches packed up to the request limits.
+    Each append response lists the blocks it created, in order: their ids are
+    recorded in block_id_map under the path of the block they were created from.
+    Batches are journaled under the path of their first block, so a resumed
+    run skips the ones that already went through. Rejected batches are
+    bisected down to the blocks at fault, see append_batch.
+    Appends to a parent stop at the first batch that fails: the next ones
+    would be written before it once a resumed run appends it. Returns the
+    number of batches not appended.
+    """
+    batches = enumerate(pack_blocks(blocks, first_index), 1)
+    for batch_number, (batch_index, batch) in batches:
+        batch_key = path_prefix + (batch_index,)
+        if journal is not None and source_id is not None:
+            appended_ids = journal.completed_batch(source_id, batch_key)
+            if appended_ids is not None:
+                print(f"Batch {batch_number} already appended")
+                block_id_map.update(appended_ids)
+                continue
+        print(
+            f"Appending batch {batch_number} with {len(batch)} blocks")
+        preflight.report(preflight.check_payload(batch), f"batch {batch_number}")
+
+        try:
+            appended_ids = append_batch(
+                parent_id, batch, batch_index, path_prefix, source_id, batch_key)
+            print(f"Successfully appended batch {batch_number}")
+        except APIResponseError as append_error:
+            print(
+                f"Error appending batch {batch_number}: {append_error.code}")
+            logging.error(
+                f"Failed to append blocks batch {batch_number}: {append_error}")
+            return 1 + sum(1 for _ in batches)
+        block_id_map.update(appended_ids)
+    return 0
+
+
+def list_block_ids(path, block_id_map):
+    """Record the ids of the children of the block at path, created inline with it. Returns 1 on failure."""
+    try:
+        with span("list block ids", path=list(path)):
+            for i, block in enumerate(list_children(block_id_map[path])):
+                block_id_map[path + (i,)] = block.get("id")
+    except APIResponseError as structure_error:
+        print(f"Error fetching block structure: {structure_error.code}")
+        logging.error(
+            f"Failed to fetch block structure: {structure_error}")
+        return 1
+    return 0
+
+
+def append_deep_blocks(deep_blocks, block_id_map, source_id=None):
+    """
+    Append the deep block groups, level by level, at any depth.
+    A group is submitted as soon as the id of its parent is known: from the
+    response of the append that created the parent or, for columns created
+    inline with their column_list, from a listing of the column_list.
+    Groups of different parents are appended concurrently on APPEND_WORKERS
+    threads; the batches of one group are appended in order.
+    Returns the number of failures: batches and listings that failed, and
+    groups whose parent was never created.
+    """
+    waiting = dict(deep_blocks)
+    listed = set()
+    failures = 0
+
+    def append_group(parent_path, group):
+        with span("append group", path=list(parent_path), blocks=len(group)):
+            return append_blocks(block_id_map[parent_path], group, parent_path, block_id_map,
+                                 source_id=source_id)
+    with ThreadPoolExecutor(max_workers=APPEND_WORKERS) as executor:
+        pending = set()
+        while True:
+            for parent_path in sorted(waiting, key=len):
+                if parent_path in block_id_map:
+                    print(
+                        f"Appending deep blocks to parent at path {parent_path}")
+                    pending.add(executor.submit(
+                        copy_context().run, append_group, parent_path, waiting.pop(parent_path)))
+                elif (len(parent_path) > 1 and parent_path[:-1] in block_id_map
+                      and parent_path[:-1] not in deep_blocks and parent_path[:-1] not in listed):
+                    listed.add(parent_path[:-1])
+                    pending.add(executor.submit(
+                        copy_context().run, list_block_ids, parent_path[:-1], block_id_map))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                failures += future.result()
+    for parent_path in waiting:
+        print(
+            f"Could not find block ID for parent path {parent_path}")
+        failures += 1
+    return failures
 
-    return filtered_blocks
 
+def clear_page(page_id):
+    """Delete every top level block of a page before writing its new content."""
+    blocks = list_children(page_id)
+    print(f"Deleting {len(blocks)} blocks of page {page_id}")
+    for block in blocks:
+        notion.blocks.delete(block_id=block.get("id"))
 
-def get_all_children(block_id):
-    children = collect_paginated_api(
-        notion.blocks.children.list, block_id=block_id)
-    index = 0
-    for child in children:
-        # Remove parent key to create unique new object
-        child.pop('parent', None)
-        child.pop('created_time', None)
-        child.pop('created_by', None)
-        child.pop('last_edited_by', None)
-        child.pop('last_edited_time', None)
-        # If the block is an image or an external link, replace it with a warning because it's not supported by the API **yet**
-        type = child.get("type")
-        if type == "image" or type == "external":
-            global imagenum
-            imagenum += 1
-            children[index] = {"paragraph": {
-                "rich_text": [
-                    {"text": {"content": "⚠️ Go fetch the image from the original doc ⚠️"},
-                     "annotations": {
-                        "bold": True,
-                        "italic": False,
-                        "strikethrough": False,
-                        "underline": True,
-                        "code": False,
-                        "color": "red"
-                    }, }]}}
-        # File blocks must have an external property defined
-        elif type == "file" and (not child.get("file") or not child.get("file").get("external")):
-            children[index] = {"paragraph": {
-                "rich_text": [
-                    {"text": {"content": "⚠️ Go fetch the file from the original doc ⚠️"},
-                     "annotations": {
-                        "bold": True,
-                        "italic": False,
-                        "strikethrough": False,
-                        "underline": True,
-                        "code": False,
-                        "color": "red"
-                    }, }]}}
-        # The `link_preview` block can only be returned as part of a response. The API does not support creating or appending `link_preview` blocks.
-        # If the block is a link preview or a link mention within a rich text, replace it with a text block
-        if child.get(type).get("rich_text", False):
-            index2 = 0
-            for text in child.get(type).get("rich_text"):
-                sub_type = text.get("type")
-                if sub_type == "mention":
-                    block_type = text.get("mention").get("type")
-                    if block_type == "link_preview":
-                        children[index][type]["rich_text"][index2] = {
-                            "text": {"content": text.get("mention").get(block_type).get("url")}, }
-                    elif block_type == "link_mention":
-                        children[index][type]["rich_text"][index2] = {
-                            "text": {"content": text.get("mention").get(block_type).get("href")}, }
-                index2 += 1
-        # If the block is a link preview or a link mention, replace it with a bookmark block
-        if type == "link_preview":
-            children[index] = {
-                "object": "block",
-                "type": "bookmark",
-                "bookmark": {
-                    "url": child.get("link_preview").get("url")
-                }
-            }
-        elif type == "link_mention":
-            children[index] = {
-                "object": "block",
-                "type": "bookmark",
-                "bookmark": {
-                    "url": child.get("link_mention").get("href")
-                }
-            }
-        # Continue recursively if the block has children
-        if child.get("has_children"):
-            child[child.get("type")]["children"] = get_all_children(
-                child.get("id"))
-            # remove id after getting children, to force creation of new block
-            child.pop('id', None)
-        index += 1
-    # Filter out any unsupported blocks
-    global unsupported_blocks_removed
-    unsupported_blocks_removed = 0
-    children = filter_unsupported_blocks(children)
-    if unsupported_blocks_removed > 0:
-        logging.info(
-            f"Removed {unsupported_blocks_removed} unsupported block(s)")
-        print(f"Removed {unsupported_blocks_removed} unsupported block(s)")
-    # Return all children without splitting (preparation will happen later)
-    # Return all children without splitting (preparation will happen later)
-    return children
 
+def load_watermark(path):
+    """Return the start time of the last successful sync, None before the first one."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as state:
+        return json.load(state).get("watermark")
 
-def split_long_code_blocks(blocks):
-    """
-    Split code blocks that exceed MAX_CODE_BLOCK_LENGTH characters into multiple blocks.
-    Returns a flat list of blocks with long code blocks split into multiple sequential blocks.
-    """
-    if not isinstance(blocks, list):
-        return blocks
 
-    result = []
+def save_watermark(path, watermark):
+    with open(path, "w") as state:
+        json.dump({"watermark": watermark}, state)
 
-    for block in blocks:
-        if not isinstance(block, dict):
-            result.append(block)
-            continue
-
-        # Handle code blocks with content exceeding the limit
-        if block.get("type") == "code" and "code" in block:
-            rich_text = block["code"].get("rich_text", [])
-            if rich_text and len(rich_text) > 0:
-                content = rich_text[0].get("text", {}).get("content", "")
-
-                if len(content) > MAX_CODE_BLOCK_LENGTH:
-                    language = block["code"].get("language", "plain text")
-
-                    # Split content into chunks
-                    chunks = [content[i:i+MAX_CODE_BLOCK_LENGTH]
-                              for i in range(0, len(content), MAX_CODE_BLOCK_LENGTH)]
-
-                    # Create a block for each chunk
-                    for i, chunk in enumerate(chunks):
-                        # Copy the original block for the first chunk
-                        if i == 0:
-                            new_block = dict(block)
-                            new_block["code"]["rich_text"][0]["text"]["content"] = chunk
-                        else:
-                            # Create continuation blocks for remaining chunks
-                            new_block = {
-                                "type": "code",
-                                "object": "block",
-                                "code": {
-                                    "rich_text": [{"type": "text", "text": {"content": chunk}}],
-                                    "language": language
-                                }
-                            }
-                        result.append(new_block)
-                    continue  # Skip appending the original block
-
-        # Process nested children recursively
-        if block.get("has_children"):
-            block_type = block.get("type")
-            if block_type and block_type in block and "children" in block[block_type]:
-                block[block_type]["children"] = split_long_code_blocks(
-                    block[block_type]["children"])
-
-        # Add the block to the result
-        result.append(block)
-
-    return result
-
-
-def create_minimal_valid_block(block_type, structure_details=None):
-    """
-    Create a minimal valid block structure based on block type.
-    Some block types require specific structures to be valid.
 
-    Parameters:
-    - block_type: The type of block to create
-    - structure_details: Optional dictionary containing structure information (e.g., table width)
-    """
-    """
-    Create a minimal valid block structure based on block type.
-    Some block types require specific structures to be valid.
-    """
-    if block_type == "table":
-        # Tables must have at least one table_row with the correct number of cells
-        table_width = 1  # Default to 1 cell if structure_details not provided
-        if structure_details and "table_width" in structure_details:
-            table_width = structure_details["table_width"]
-
-        # Create an empty table_row with the correct number of cells
-        return {
-            "object": "block",
-            "type": "table_row",
-            "table_row": {
-                # Empty cell for each column
-                "cells": [[] for _ in range(table_width)]
-            }
+def source_query(since=None):
+    """Arguments of the query of the source database, only for pages edited on or after since if given."""
+    query = {"database_id": SOURCE_DATABASE_ID}
+    if since is not None:
+        query["filter"] = {
+            "timestamp": "last_edited_time",
+            "last_edited_time": {"on_or_after": since},
         }
-    elif block_type == "column_list":
-        # Column lists should have at least one column
-        return {
-            "object": "block",
-            "type": "column",
-            "column": {
-                "children": []
-            }
-        }
-    elif block_type == "column":
-        # Columns can have an empty children array
-        return None
-    else:
-        # Default case - most blocks can have empty children arrays
-        return None
+    return query
 
 
-def extract_deep_blocks(blocks, current_depth=0, parent_path=None):
-    """
-    Recursively identify blocks that exceed the maximum nesting depth.
-    Returns a tuple containing:
-    1. Modified blocks with deep blocks removed
-    2. Dictionary of deep blocks with their parent paths
-    """
-    if not isinstance(blocks, list):
-        return blocks, {}
-
-    if parent_path is None:
-        parent_path = []
-
-    modified_blocks = []
-    deep_blocks = {}
-
-    logging.debug(
-        f"Processing blocks at depth {current_depth}, path {parent_path}")
-
-    # Enforce stricter nesting depth - extract blocks at the maximum depth
-    # rather than exceeding it
-    if current_depth >= MAX_NESTING_DEPTH:
-        logging.warning(
-            f"Found deeply nested blocks at depth {current_depth} - path {parent_path}")
-        # Store entire block collection at too deep a level
-        path_key = tuple(parent_path[:-1]) if parent_path else tuple()
-        deep_blocks[path_key] = blocks
-        return [], deep_blocks
-
-    for i, block in enumerate(blocks):
-        if not isinstance(block, dict):
-            modified_blocks.append(block)
-            continue
-
-        # Create a path to this block
-        current_path = parent_path + [i]
-
-        # Check if this block has children
-        if block.get("has_children"):
-            block_type = block.get("type")
-
-            # Print details about column_list blocks for debugging
-            # Print details about special block types for debugging
-            if block_type == "column_list":
-                logging.debug(
-                    f"Found column_list block at path {current_path}")
-                if "column_list" in block and "children" in block["column_list"]:
-                    logging.debug(
-                        f"  Column list has {len(block['column_list']['children'])} columns")
-                    for j, column in enumerate(block["column_list"]["children"]):
-                        if column.get("type") == "column" and "column" in column:
-                            has_children = "children" in column["column"]
-                            children_count = len(column["column"].get(
-                                "children", [])) if has_children else 0
-                            logging.debug(
-                                f"  Column {j} has_children: {has_children}, children_count: {children_count}")
-            elif block_type == "table":
-                logging.debug(
-                    f"Found table block at path {current_path}")
-                if "table" in block and "children" in block["table"]:
-                    table_children = block["table"]["children"]
-                    logging.debug(
-                        f"  Table has {len(table_children)} rows")
-
-                    # Determine the table width by analyzing the first row
-                    table_width = 0
-                    if table_children and len(table_children) > 0:
-                        first_row = table_children[0]
-                        if first_row.get("type") == "table_row" and "table_row" in first_row:
-                            if "cells" in first_row["table_row"]:
-                                table_width = len(
-                                    first_row["table_row"]["cells"])
-                                logging.debug(
-                                    f"  Table width determined to be {table_width} cells")
-
-                    for j, row in enumerate(table_children):
-                        if row.get("type") == "table_row" and "table_row" in row:
-                            has_cells = "cells" in row["table_row"]
-                            cells_count = len(row["table_row"].get(
-                                "cells", [])) if has_cells else 0
-                            logging.debug(
-                                f"  Row {j} has_cells: {has_cells}, cells_count: {cells_count}")
-            if block_type and block_type in block and "children" in block[block_type]:
-                children = block[block_type]["children"]
-
-                # Log the structure for debugging
-                logging.debug(
-                    f"Block {current_path} of type {block_type} has {len(children)} children at depth {current_depth}")
-
-                # If we're at max depth, extract children for later appending
-                if current_depth >= MAX_NESTING_DEPTH - 1:
-                    # Store these children with their parent path
-                    path_key = tuple(current_path)
-                    deep_blocks[path_key] = children
-
-                    # List of block types that require children property to always be defined
-                    # even if empty, or Notion API will reject the request
-                    special_block_types = ["column_list", "column", "table"]
-
-                    # Special handling for blocks that need to have a children property
-                    # even if it's empty
-                    if block_type in special_block_types:
-                        logging.info(
-                            f"Preserving minimal valid structure for {block_type} at path {current_path}")
-
-                        # Create minimal valid structure
-                        # Extract structure details if needed
-                        structure_details = {}
-
-                        if block_type == "table" and "children" in block[block_type] and len(block[block_type]["children"]) > 0:
-                            # For tables, determine the width by looking at the first row
-                            first_row = block[block_type]["children"][0]
-                            if first_row.get("type") == "table_row" and "table_row" in first_row:
-                                if "cells" in first_row["table_row"]:
-                                    structure_details["table_width"] = len(
-                                        first_row["table_row"]["cells"])
-                                    logging.info(
-                                        f"Detected table with {structure_details['table_width']} cells per row at {current_path}")
-
-                        # Create minimal valid structure with the detected details
-                        minimal_block = create_minimal_valid_block(
-                            block_type, structure_details)
-
-                        if minimal_block and block_type == "table":
-                            # Tables must have at least one table_row child with the correct number of cells
-                            block[block_type]["children"] = [minimal_block]
-                            logging.info(
-                                f"Added placeholder table_row to table at path {current_path} with {structure_details.get('table_width', 0)} cells")
-                            # Column lists should have at least one column
-                            block[block_type]["children"] = [minimal_block]
-                            logging.info(
-                                f"Added placeholder column to column_list at path {current_path}")
-                        else:
-                            # Other special blocks can have empty children arrays
-                            block[block_type]["children"] = []
-                    else:
-                        # Remove children from the block for initial creation
-                        del block[block_type]["children"]
-
-                    logging.info(
-                        f"Extracted {len(children)} deeply nested blocks at path {current_path} for later appending")
-                else:
-                    # Process children recursively
-                    processed_children, child_deep_blocks = extract_deep_blocks(
-                        children, current_depth + 1, current_path)
-                    block[block_type]["children"] = processed_children
-                    # Add any deep blocks found in children
-                    deep_blocks.update(child_deep_blocks)
-
-        modified_blocks.append(block)
-
-    return modified_blocks, deep_blocks
-
-
-def prepare_blocks_for_notion(blocks):
-    """
-    Prepare blocks for Notion API by handling validation constraints:
-    - Splits code blocks exceeding MAX_CODE_BLOCK_LENGTH characters
-    - Extracts blocks that exceed MAX_NESTING_DEPTH for later appending
-    - Returns prepared blocks for initial page creation and data for later appending
-    """
-    if not isinstance(blocks, list):
-        return blocks, [], {}
+def query_source_pages(since=None):
+    """Stream the pages of the source database, one result page of the query at a time."""
+    return iterate_paginated_api(notion.databases.query, **source_query(since))
 
-    # First split any code blocks that exceed the character limit
-    blocks_with_split_code = split_long_code_blocks(blocks)
 
-    # Extract deeply nested blocks
-    blocks_with_proper_depth, deep_blocks = extract_deep_blocks(
-        blocks_with_split_code)
+def hold_blocks(doc, blocks):
+    """Count the blocks of a fetched tree in flight until release_blocks(doc)."""
+    if in_flight is not None:
+        in_flight.add(doc.get("id"), sum(block_count(block) for block in blocks))
 
-    # Then separate blocks for initial page creation (up to MAX_BLOCKS_PER_PAGE)
-    # from excess blocks that will be appended later
-    initial_blocks = blocks_with_proper_depth[:MAX_BLOCKS_PER_PAGE]
-    excess_blocks = blocks_with_proper_depth[MAX_BLOCKS_PER_PAGE:]
 
-    return initial_blocks, excess_blocks, deep_blocks
+def release_blocks(doc):
+    if in_flight is not None:
+        in_flight.release(doc.get("id"))
 
 
-try:
-    notion = Client(
-        auth="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",)
-    # Tech notes : ab4ac06a5b6b45ed951df04307a90663
-    # Doc tech 7c572848e4f04761b659c8f14c6d516e
-    # Test db 1818f3776f4f80158a6ac3fd054fc9c5
-    # All theodoers e2fa07c0424b473f994f176a636bec2a
-    doctech = collect_paginated_api(
-        notion.databases.query, database_id="7c572848e4f04761b659c8f14c6d516e"
-    )
-    # List over every doctech
-    for doc in doctech:
-        # Get all first level children blocks
-        all_blocks = get_all_children(
-            doc.get("id"))
-        # Create a page in the Test db wit the same name and blocks
-        name = "".join([title.get("plain_text")
-                       for title in doc.get("properties").get("Name").get("title")])
-        print(name)
-        # Print block and its index
-        # for index, block in enumerate(all_blocks):
-        #     print(index, block)
-        label = doc.get("properties").get(
-            "Type").get("select").get("name")
-
-        # Get the person who created the doc
-        person = doc.get("properties").get("Created By").get(
-            "created_by").get("person", None)
-
-        if person is not None:
-            created_by = person.get("email")
-            print("Searching "+created_by)
-            # Find the theodoer in the related database
-            owner = notion.databases.query(
-                **{
-                    "database_id": "e2fa07c0424b473f994f176a636bec2a",
-                    "filter": {
-                        "property": "⚙️ Email",
-                        "rich_text": {
-                            "contains": created_by,
-                        },
-                    },
-                }
-            )
-            if owner.get("results") == [] or len(owner.get("results")) > 1:
-                print("Owner not found")
-            else:
-                print("Owner found")
-            owner_id = owner.get("results")[0].get("id")
-            prop = {
-                "Name": {"title": [{"text": {"content": name}}]},
-                "Type": {"select": {"name": label}},
-                "Owner": {"relation": [{"id": owner_id}]},
-                "Experts": {"relation": [{"id": owner_id}]},
-            }
-        else:
-            print("Original owner left the company")
+def wait_for_room():
+    if in_flight is not None:
+        in_flight.wait_for_room()
+
+
+def build_properties(doc):
+    """
+    Build the properties of the target page: name, type and, when the creator
+    is still in the people database, owner and experts.
+    """
+    # Create a page in the Test db wit the same name and blocks
+    name = "".join([title.get("plain_text")
+                   for title in doc.get("properties").get("Name").get("title")])
+    print(name)
+    label = doc.get("properties").get(
+        "Type").get("select").get("name")
+
+    # Get the person who created the doc
+    person = doc.get("properties").get("Created By").get(
+        "created_by").get("person", None)
+
+    prop = {
+        "Name": {"title": [{"text": {"content": name}}]},
+        "Type": {"select": {"name": label}},
+    }
+    if person is not None:
+        created_by = person.get("email")
+        print("Searching "+created_by)
+        # Find the theodoer in the related database
+        owner_id = people.resolve(created_by)
+        if owner_id is None:
             # Create page without owner
-            prop = {
-                "Name": {"title": [{"text": {"content": name}}]},
-                "Type": {"select": {"name": label}},
-            }
-
-        total_blocks = len(all_blocks)
-        print(f"Count of blocks: {total_blocks}")
-        # Prepare blocks for Notion - handle code block length limits, block count limits, and nesting depth limits
+            print("Owner not found")
+        else:
+            print("Owner found")
+            prop["Owner"] = {"relation": [{"id": owner_id}]}
+            prop["Experts"] = {"relation": [{"id": owner_id}]}
+    else:
+        # Create page without owner
+        print("Original owner left the company")
+    return prop
+
+
+def is_migrated(doc):
+    """True if the journal says doc needs no write: migrated, and in sync mode unchanged since."""
+    if journal is None or not journal.is_done(doc.get("id")):
+        return False
+    if not sync_mode:
+        print(f"Skipping {doc.get('id')}, already migrated")
+        return True
+    if journal.is_up_to_date(doc.get("id"), doc.get("last_edited_time")):
+        print(f"Skipping {doc.get('id')}, unchanged since last sync")
+        return True
+    return False
+
+
+def fetch_doc(doc):
+    """Pipeline fetch stage: download the source tree and build the page properties."""
+    if is_migrated(doc):
+        return None
+    wait_for_room()
+    # Get all first level children blocks
+    with for_page(doc.get("id")), span("fetch") as details:
+        all_blocks = get_all_children(
+            doc.get("id"), doc.get("last_edited_time"))
+        details["blocks"] = tree_stats(all_blocks)[0]
+    hold_blocks(doc, all_blocks)
+    return doc, build_properties(doc), all_blocks
+
+
+def load_record(record):
+    """Pipeline fetch stage of the import mode: read the page and its tree from an archive record."""
+    doc = record["page"]
+    if is_migrated(doc):
+        return None
+    wait_for_room()
+    hold_blocks(doc, record["blocks"])
+    return doc, build_properties(doc), record["blocks"]
+
+
+def rehost_doc(fetched):
+    """Pipeline stage: copy the files of the tree to the target workspace before the transformation."""
+    doc, prop, all_blocks = fetched
+    with for_page(doc.get("id")), span("rehost"):
+        rehoster.rehost_tree(all_blocks)
+    return fetched
+
+
+def transform_doc(fetched):
+    """Pipeline transform stage: split the tree into create, append and deep batches."""
+    doc, prop, all_blocks = fetched
+    total_blocks = len(all_blocks)
+    print(f"Count of blocks: {total_blocks}")
+    if tracer is not None:
+        tracer.name_page(doc.get("id"), prop["Name"]["title"][0]["text"]["content"],
+                         prop["Type"]["select"]["name"])
+    # Prepare blocks for Notion - handle code block length limits, block count limits, and nesting depth limits
+    with for_page(doc.get("id")), span("transform") as details:
         initial_blocks, excess_blocks, deep_blocks = prepare_blocks_for_notion(
             all_blocks)
-        print(
-            f"Prepared {len(initial_blocks)} initial blocks with {len(excess_blocks)} excess blocks and {len(deep_blocks)} deep block groups")
-        # First create the page with the initial batch of blocks (up to 100)
-        print(f"Creating page with initial {len(initial_blocks)} blocks")
-
-        new_page = notion.pages.create(
-            parent={"database_id": "1818f3776f4f80158a6ac3fd054fc9c5"},  # Test Db
-            properties=prop,
-            children=initial_blocks,
-        )
-        page_id = new_page.get("id")
-        print(f"Page created {page_id}")
+        details.update(initial=len(initial_blocks), excess=len(excess_blocks), deep_groups=len(deep_blocks))
+    print(
+        f"Prepared {len(initial_blocks)} initial blocks with {len(excess_blocks)} excess blocks and {len(deep_blocks)} deep block groups")
+    return doc, prop, initial_blocks, excess_blocks, deep_blocks
 
-        # If we have excess blocks, append them directly to the page
-        if excess_blocks:
-            print(f"Adding {len(excess_blocks)} excess blocks to append")
 
-            # Append blocks in batches
-            batch_size = MAX_BLOCKS_PER_PAGE
+def load_target_index():
+    """Index the pages of the target database, but the ones the journal already maps to a source page."""
+    index = TargetIndex.load(notion, target_database_id)
+    if journal is not None:
+        for page in journal.pages.values():
+            index.claim(page["target"])
+    return index
 
-            for i in range(0, len(excess_blocks), batch_size):
-                batch = excess_blocks[i:i+batch_size]
-                batch_number = (i // batch_size) + 1
-                print(
-                    f"Appending batch {batch_number} with {len(batch)} blocks")
 
+def dedup_doc(fetched):
+    """
+    Pipeline stage: link a page identical to one already in the target
+    database, written by a run whose journal is lost, instead of writing it again.
+    Runs on the fetched tree, before its files are copied: the tree is
+    compared as prepared without copies, its files hash like the ones the
+    target page holds, copied or replaced with a warning (see hosted_file_kind).
+    """
+    doc, prop, all_blocks = fetched
+    source_id = doc.get("id")
+    if journal is not None and journal.target_page(source_id) is not None:
+        return fetched
+    with for_page(source_id), span("dedup"):
+        # The tree is a copy of the page: only build it for a page with a candidate target
+        target_id = target_index.find(
+            prop, lambda: prepared_tree(*prepare_blocks_for_notion(copy.deepcopy(all_blocks))),
+            get_all_children)
+    if target_id is None:
+        return fetched
+    print(f"Page {target_id} of the target database is identical, linking it instead of writing it")
+    if journal is not None:
+        journal.record_page(source_id, target_id)
+        journal.record_done(source_id, doc.get("last_edited_time"))
+    release_blocks(doc)
+    return None
+
+
+def write_doc(prepared):
+    """Pipeline write stage: create the target page and append the remaining blocks."""
+    doc, prop, initial_blocks, excess_blocks, deep_blocks = prepared
+    source_id = doc.get("id")
+    with for_page(source_id):
+        page_id = journal.target_page(source_id) if journal is not None else None
+        if page_id is not None and journal.is_done(source_id):
+            # Sync: the source was edited since the page was migrated, rewrite it
+            print(f"Updating page {page_id}")
+            with span("update"):
+                preflight.report(preflight.check_properties(prop), "the page properties")
+                notion.pages.update(page_id=page_id, properties=prop)
+                clear_page(page_id)
+            journal.record_reset(source_id)
+        elif page_id is not None:
+            # A previous run created the page but stopped before writing everything
+            print(f"Resuming page {page_id}")
+        # Deep blocks are appended to blocks created on this run: their ids are
+        # read from the append responses, the initial blocks only hold blocks
+        # whose ids are not needed. A page that exists already holds the top
+        # level blocks its creation wrote, whatever this run packs first: all
+        # the others go through appends, from the first one not written yet.
+        block_id_map = {}
+        failures = 0
+        if page_id is not None:
+            top_level_blocks = initial_blocks + excess_blocks
+            written_initially = journal.initial_blocks(source_id)
+            initial_blocks = top_level_blocks[:written_initially]
+            excess_blocks = top_level_blocks[written_initially:]
+            if any(path[0] < written_initially for path in deep_blocks):
+                # The creation did not return the ids of these parents
+                block_id_map[()] = page_id
+                failures += list_block_ids((), block_id_map)
+        if page_id is None:
+            # First create the page with the initial batch of blocks (up to 100)
+            print(f"Creating page with initial {len(initial_blocks)} blocks")
+            preflight.report(preflight.check_properties(prop) + preflight.check_payload(initial_blocks),
+                             "the page creation")
+
+            with span("create", blocks=len(initial_blocks)):
                 try:
-                    notion.blocks.children.append(
-                        block_id=page_id,
-                        children=batch
+                    new_page = notion.pages.create(
+                        parent={"database_id": target_database_id},
+                        properties=prop,
+                        children=initial_blocks,
                     )
-                    print(f"Successfully appended batch {batch_number}")
-                except APIResponseError as append_error:
-                    print(
-                        f"Error appending batch {batch_number}: {append_error.code}")
-                    logging.error(
-                        f"Failed to append blocks batch {batch_number}: {append_error}")
+                except APIResponseError as create_error:
+                    if create_error.code != APIErrorCode.ValidationError.value or not initial_blocks:
+                        raise
+                    # Create the page empty: its blocks go through the appends, that single out the bad ones
+                    print(f"Page creation rejected ({create_error.code}), creating it empty")
+                    new_page = notion.pages.create(
+                        parent={"database_id": target_database_id},
+                        properties=prop,
+                        children=[],
+                    )
+                    excess_blocks = initial_blocks + excess_blocks
+                    initial_blocks = []
+            page_id = new_page.get("id")
+            print(f"Page created {page_id}")
+            if journal is not None:
+                journal.record_page(source_id, page_id, len(initial_blocks))
+
+        # If we have excess blocks, append them directly to the page
+        if excess_blocks:
+            print(f"Adding {len(excess_blocks)} excess blocks to append")
+            with span("append excess", blocks=len(excess_blocks)):
+                failures += append_blocks(page_id, excess_blocks, (), block_id_map,
+                              first_index=len(initial_blocks), source_id=source_id)
 
         # If we have deeply nested blocks, append them to their parent blocks
         if deep_blocks:
             print(f"Processing {len(deep_blocks)} deeply nested block groups")
+            with span("append deep", groups=len(deep_blocks)):
+                failures += append_deep_blocks(deep_blocks, block_id_map, source_id)
+        if failures:
+            # Not done: the next run resumes the page from the writes that failed
+            print(f"Page {page_id} is incomplete: {failures} write(s) failed")
+            logging.error(f"Page {page_id} of {source_id} is incomplete: {failures} write(s) failed")
+            incomplete_pages.append(source_id)
+        else:
+            if journal is not None:
+                journal.record_done(source_id, doc.get("last_edited_time"))
+            if metrics is not None:
+                metrics.page_migrated(source_id)
+    release_blocks(doc)
+    return None if failures else page_id
 
-            # First, get the full block structure of the created page to find block IDs
-            try:
-                # Get the block structure of the created page
-                page_structure = collect_paginated_api(
-                    notion.blocks.children.list, block_id=page_id)
-
-                # Create a mapping of block positions to their IDs
-                block_id_map = {}
-
-                def map_block_ids(blocks, path_prefix=None):
-                    if path_prefix is None:
-                        path_prefix = []
-
-                    for i, block in enumerate(blocks):
-                        current_path = path_prefix + [i]
-                        path_key = tuple(current_path)
-                        block_id_map[path_key] = block.get("id")
-
-                        # If this block has children, recursively map them
-                        if block.get("has_children"):
-                            child_blocks = collect_paginated_api(
-                                notion.blocks.children.list, block_id=block.get("id"))
-                            map_block_ids(child_blocks, current_path)
-
-                # Map all block IDs in the created page
-                map_block_ids(page_structure)
-
-                # Now append deeply nested blocks to their parents
-                for parent_path, children in deep_blocks.items():
-                    if parent_path in block_id_map:
-                        parent_id = block_id_map[parent_path]
-                        print(
-                            f"Appending deep blocks to parent at path {parent_path}")
-
-                        try:
-                            notion.blocks.children.append(
-                                block_id=parent_id,
-                                children=children
-                            )
-                            print(
-                                f"Successfully appended deep blocks to parent {parent_id}")
-                        except APIResponseError as deep_append_error:
-                            print(
-                                f"Error appending deep blocks: {deep_append_error.code}")
-                            logging.error(
-                                f"Failed to append deep blocks: {deep_append_error}")
-                    else:
-                        print(
-                            f"Could not find block ID for parent path {parent_path}")
-
-            except APIResponseError as structure_error:
-                print(f"Error fetching page structure: {structure_error.code}")
-                logging.error(
-                    f"Failed to fetch page structure: {structure_error}")
-
-except APIResponseError as error:
-    if error.code == APIErrorCode.ObjectNotFound:
-        logging.error(error)
-    elif error.code == "validation_error":
-        logging.error("validation_error")
-        logging.error(error)
-
-        # Extract information about deeply nested blocks from the error message
-        error_msg = str(error)
-        if "children" in error_msg and "should be not present" in error_msg:
-            # Extract the problematic path from the error message
-            import re
-            path_match = re.search(
-                r'body\.children\[\d+\]\..*?children', error_msg)
-            if path_match:
-                problematic_path = path_match.group(0)
-                logging.error(
-                    f"Detected problematic deeply nested path: {problematic_path}")
 
-                # Count the nesting depth from the path
-                nesting_depth = problematic_path.count("children")
-                logging.error(
-                    f"Nesting depth of problematic blocks: {nesting_depth}")
-                logging.error(
-                    f"Consider reducing MAX_NESTING_DEPTH to {MAX_NESTING_DEPTH-1}")
+def migrate(docs, on_page_written=None, fetch=fetch_doc, max_in_flight_blocks=MAX_IN_FLIGHT_BLOCKS):
+    """
+    Fetch, transform and write every doc in overlapping stages:
+    while a page is written the next ones are already fetched and prepared.
+    Docs are processed as they come and each tree is dropped once written;
+    no new tree is fetched while max_in_flight_blocks are waiting to be written.
+    fetch is the first stage, load_record to import archive records instead.
+    on_page_written, if given, is called with the id of each page written.
+    Returns the ids of the pages written.
+    """
+    stages = [fetch, transform_doc, write_doc]
+    if rehoster is not None:
+        stages.insert(1, rehost_doc)
+    # Before the files are copied: a page linked to its duplicate costs no write
+    if target_index is not None:
+        stages.insert(1, dedup_doc)
+    if on_page_written is not None:
+        def report(page_id):
+            on_page_written(page_id)
+            return page_id
+        stages.append(report)
+    global in_flight
+    in_flight = InFlightLimit(max_in_flight_blocks)
+    return run_pipeline(docs, stages, in_flight=in_flight)
+
+
+def export_doc(doc):
+    """Pipeline fetch stage of the export mode: download the source tree."""
+    wait_for_room()
+    with for_page(doc.get("id")):
+        blocks = get_all_children(doc.get("id"), doc.get("last_edited_time"))
+    hold_blocks(doc, blocks)
+    return doc, blocks
+
+
+def export(docs, path, max_in_flight_blocks=MAX_IN_FLIGHT_BLOCKS):
+    """
+    Export mode: stream every doc and its block tree to the archive at path,
+    skipping the docs it already holds in this version.
+    Returns the ids of the docs exported.
+    """
+    global in_flight
+    archive = ArchiveWriter(path)
 
-            # Log a warning that we need to extract more deeply nested blocks
-            logging.error(
-                "This error indicates blocks nested too deeply. Review MAX_NESTING_DEPTH setting.")
+    def write(exported):
+        source_id = archive.write(exported)
+        release_blocks(exported[0])
+        return source_id
+
+    try:
+        docs = (doc for doc in docs if not archive.is_archived(doc))
+        in_flight = InFlightLimit(max_in_flight_blocks)
+        return run_pipeline(docs, [export_doc, write], in_flight=in_flight)
+    finally:
+        archive.close()
+
+
+def plan(docs, max_in_flight_blocks=MAX_IN_FLIGHT_BLOCKS, rehost_files=True):
+    """
+    Plan mode: fetch and prepare every doc like the migration does, without
+    writing anything, and count the requests its write would make, the
+    copies of the hosted files included unless rehost_files is False.
+    Returns the Plan.
+    """
+    global in_flight
+    migration_plan = Plan(notion.limiter.rate)
+
+    def plan_doc(fetched):
+        doc, prop, all_blocks = fetched
+        source_stats = tree_stats(all_blocks)
+        # With the block cache, the migration reads the trees fetched here from disk
+        fetch = 0 if cache is not None else fetch_requests(all_blocks)
+        # Before the transformation, that replaces the files not copied with a warning
+        hosted_files = [source_of(block[block["type"]]["file"]["url"])
+                        for block in hosted_file_blocks(all_blocks)] if rehost_files else []
+        _, _, initial_blocks, excess_blocks, deep_blocks = transform_doc(fetched)
+        name = "".join(title.get("text", {}).get("content", "") for title in prop["Name"]["title"])
+        # Sync: a page migrated before is rewritten, see write_doc
+        rewritten_blocks = None
+        if journal is not None and journal.is_done(doc.get("id")):
+            rewritten_blocks = journal.top_level_blocks(doc.get("id"))
+        migration_plan.add(name, doc.get("id"), source_stats, fetch,
+                           (initial_blocks, excess_blocks, deep_blocks), rewritten_blocks, hosted_files)
+        release_blocks(doc)
+        return doc.get("id")
+
+    in_flight = InFlightLimit(max_in_flight_blocks)
+    planned = run_pipeline(docs, [fetch_doc, plan_doc], in_flight=in_flight)
+    # The query of the source database
+    migration_plan.setup_requests = max(1, -(-len(planned) // 100))
+    return migration_plan
+
+
+def verify_doc(doc, target_pages, state):
+    """
+    Compare a migrated page with its source: the target must hold the tree
+    the migration writes from the source as it is now, and its properties.
+    Pages found identical before, with neither side edited since, are skipped.
+    """
+    source_id = doc.get("id")
+    target_id = journal.target_page(source_id) if journal is not None else None
+    result = {"source": source_id, "target": target_id}
+    if target_id is None or not journal.is_done(source_id):
+        return {**result, "status": "not migrated"}
+    if target_id not in target_pages:
+        return {**result, "status": "target missing"}
+    edited = [doc.get("last_edited_time"), target_pages[target_id].get("last_edited_time")]
+    if state.get(source_id) == edited:
+        return {**result, "status": "unchanged"}
+    with for_page(source_id), span("verify"):
+        prop = build_properties(doc)
+        initial_blocks, excess_blocks, deep_blocks = prepare_blocks_for_notion(
+            get_all_children(source_id, doc.get("last_edited_time")))
+        diff = verifier.compare_children(
+            prepared_tree(initial_blocks, excess_blocks, deep_blocks), target_id, list_children,
+            verifier.PageDiff(journal.pages[source_id]["substituted"]))
+    properties = verifier.changed_properties(prop, target_pages[target_id].get("properties", {}))
+    status = "different" if diff or properties else "identical"
+    if status == "identical":
+        state[source_id] = edited
     else:
-        # Other error handling code
-        logging.error(error.code)
-        logging.error(error)
+        state.pop(source_id, None)
+    return {**result, "name": prop["Name"]["title"][0]["text"]["content"], "status": status,
+            "properties": properties, **diff.as_dict()}
+
+
+def verify(docs, report_path=verifier.VERIFY_REPORT_PATH, state_path=verifier.VERIFY_STATE_PATH):
+    """
+    Verify mode: compare every migrated page with its source, VERIFY_WORKERS
+    pages at a time, and write the differences to report_path.
+    The target pages are read with one query of the target database.
+    """
+    target_pages = {page.get("id"): page for page in iterate_paginated_api(
+        notion.databases.query, database_id=target_database_id)}
+    state = verifier.load_state(state_path)
+    try:
+        with ThreadPoolExecutor(max_workers=verifier.VERIFY_WORKERS) as executor:
+            results = list(executor.map(
+                lambda doc: copy_context().run(verify_doc, doc, target_pages, state), docs))
+    finally:
+        verifier.save_state(state, state_path)
+    with open(report_path, "w") as output:
+        json.dump(results, output, indent=2, ensure_ascii=False)
+    print(verifier.report(results))
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Migrate the Doc tech database to the Test db")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always fetch source trees from the API")
+    parser.add_argument("--cache-path", default=CACHE_PATH,
+                        help="SQLite file holding the fetched source trees")
+    parser.add_argument("--journal", default=JOURNAL_PATH,
+                        help="journal of completed writes, a rerun resumes from it")
+    parser.add_argument("--sync", action="store_true",
+                        help="only migrate pages edited since the last sync, "
+                        "updating the pages migrated before")
+    parser.add_argument("--sync-state", default=SYNC_STATE_PATH,
+                        help="file holding the time of the last sync")
+    parser.add_argument("--no-rehost-files", action="store_true",
+                        help="replace the images and files hosted by Notion with a warning "
+                        "instead of uploading them to the target")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="write every page, even when an identical one is already in the target database")
+    parser.add_argument("--max-in-flight-blocks", type=int, default=MAX_IN_FLIGHT_BLOCKS,
+                        help="blocks fetched and not written yet above which fetching waits, "
+                        "bounds the memory used")
+    parser.add_argument("--metrics-json", default=METRICS_JSON_PATH,
+                        help="JSON report of the API requests made by the run")
+    parser.add_argument("--metrics-prometheus", default=METRICS_PROMETHEUS_PATH,
+                        help="the same report in the Prometheus text format")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--plan", nargs="?", const=PLAN_PATH, metavar="PLAN",
+                      help="dry run: count the requests and the time the migration would take, "
+                      f"without writing anything, and save the plan to PLAN ({PLAN_PATH})")
+    mode.add_argument("--export", metavar="ARCHIVE",
+                      help="only read: write the source pages to this archive "
+                      "(NDJSON, gzip compressed if it ends with .gz)")
+    mode.add_argument("--import", dest="import_archive", metavar="ARCHIVE",
+                      help="only write: migrate the pages of this archive, without reading the source")
+    mode.add_argument("--verify", nargs="?", const=verifier.VERIFY_REPORT_PATH, metavar="REPORT",
+                      help="only read: compare the pages of the journal with their source and write "
+                      f"the missing, extra and changed blocks to REPORT ({verifier.VERIFY_REPORT_PATH})")
+    parser.add_argument("--target-database", default=TARGET_DATABASE_ID,
+                        help="database the pages are written to; "
+                        "use another --journal when replaying into a new one")
+    parser.add_argument("--verify-state", default=verifier.VERIFY_STATE_PATH,
+                        help="pages found identical by the last verification, skipped until edited")
+    parser.add_argument("--trace", nargs="?", const=TRACE_PATH, metavar="TRACE",
+                        help="trace the phases of every page to TRACE, in the Chrome trace "
+                        f"format ({TRACE_PATH}), and print the slowest pages")
+    add_transport_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    global cache, journal, sync_mode, notion, metrics, people, target_database_id, rehoster, target_index
+    global tracer
+    args = parse_args(argv)
+    if not args.no_cache:
+        cache = BlockCache(args.cache_path)
+    journal = Journal(args.journal)
+    sync_mode = args.sync
+    target_database_id = args.target_database
+    metrics = ApiMetrics()
+    if args.trace is not None:
+        tracer = Tracer()
+
+    try:
+        notion = create_client(
+            auth="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", metrics=metrics,
+            event_loop=args.event_loop, **transport_options(args))
+        # Tech notes : ab4ac06a5b6b45ed951df04307a90663
+        # Doc tech 7c572848e4f04761b659c8f14c6d516e
+        # Test db 1818f3776f4f80158a6ac3fd054fc9c5
+        # All theodoers e2fa07c0424b473f994f176a636bec2a
+        read_only = args.export is not None or args.plan is not None or args.verify is not None
+        if not read_only and not args.no_rehost_files:
+            rehoster = FileRehoster(notion)
+        if args.export is None:
+            # Index every theodoer by email once instead of querying per doc
+            people = PeopleIndex.load(
+                notion, snapshot_path=os.environ.get("PEOPLE_INDEX_SNAPSHOT"))
+        if not read_only and not args.no_dedup:
+            target_index = load_target_index()
+        if args.import_archive is not None:
+            migrate(read_latest_records(args.import_archive), fetch=load_record,
+                    max_in_flight_blocks=args.max_in_flight_blocks)
+            return
+        if sync_mode:
+            # Notion timestamps are rounded to the minute: start the next sync at the minute this one started
+            sync_started = datetime.now(timezone.utc).replace(
+                second=0, microsecond=0).isoformat()
+            watermark = load_watermark(args.sync_state)
+            print(f"Syncing pages edited since {watermark}")
+            doctech = query_source_pages(since=watermark)
+        else:
+            doctech = query_source_pages()
+        if args.verify is not None:
+            verify(doctech, args.verify, args.verify_state)
+            return
+        if args.plan is not None:
+            migration_plan = plan(doctech, args.max_in_flight_blocks, not args.no_rehost_files)
+            print(migration_plan.report())
+            migration_plan.write(args.plan)
+            # Nothing was written, the next sync must still see these pages
+            return
+        if args.export is not None:
+            export(doctech, args.export, args.max_in_flight_blocks)
+            # Nothing was written to the target, the next sync must still see these pages
+            return
+        migrate(doctech, max_in_flight_blocks=args.max_in_flight_blocks)
+        if incomplete_pages:
+            print(f"{len(incomplete_pages)} pages are incomplete, run the migration again to resume them")
+        if sync_mode and not incomplete_pages:
+            # The next sync must see the incomplete pages again
+            save_watermark(args.sync_state, sync_started)
+
+    except APIResponseError as error:
+        if error.code == APIErrorCode.ObjectNotFound:
+            logging.error(error)
+        elif error.code == "validation_error":
+            logging.error("validation_error")
+            logging.error(error)
+
+            # Extract information about deeply nested blocks from the error message
+            error_msg = str(error)
+            if "children" in error_msg and "should be not present" in error_msg:
+                # Extract the problematic path from the error message
+                import re
+                path_match = re.search(
+                    r'body\.children\[\d+\]\..*?children', error_msg)
+                if path_match:
+                    problematic_path = path_match.group(0)
+                    logging.error(
+                        f"Detected problematic deeply nested path: {problematic_path}")
+
+                    # Count the nesting depth from the path
+                    nesting_depth = problematic_path.count("children")
+                    logging.error(
+                        f"Nesting depth of problematic blocks: {nesting_depth}")
+                    logging.error(
+                        f"Consider reducing MAX_NESTING_DEPTH to {MAX_NESTING_DEPTH-1}")
+
+                # Log a warning that we need to extract more deeply nested blocks
+                logging.error(
+                    "This error indicates blocks nested too deeply. Review MAX_NESTING_DEPTH setting.")
+        else:
+            # Other error handling code
+            logging.error(error.code)
+            logging.error(error)
+    finally:
+        if rehoster is not None:
+            rehoster.close()
+        if target_index is not None:
+            print(f"Pages linked to an identical target page: {target_index.linked}")
+        if notion is not None:
+            notion.close()
+        # Report what was sent even when the run stopped on an error
+        metrics.write(args.metrics_json, args.metrics_prometheus)
+        print(metrics.summary())
+        if tracer is not None:
+            tracer.write(args.trace)
+            print(tracer.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+import asyncio
+import contextvars
+import inspect
+import logging
+import random
+import threading
+import time
+
+import httpx
+from notion_client import AsyncClient, Client
+from notion_client import APIErrorCode
+from notion_client.api_endpoints import Endpoint
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+from api_metrics import json_size
+from tracing import count_request
+
+# Notion allows an average of three requests per second per integration
+REQUESTS_PER_SECOND = 3
+# Number of requests that can be sent back to back before throttling kicks in
+BURST_SIZE = 3
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 30
+# Connection pool of a client: idle connections stay open to be reused by the next requests
+MAX_CONNECTIONS = 32
+KEEPALIVE_EXPIRY_SECONDS = 60
+CONNECT_TIMEOUT_SECONDS = 10
+# Time to wait for a response, and for a free connection of the pool
+READ_TIMEOUT_SECONDS = 60
+
+# Error codes worth retrying: the request itself was fine, the server was not
+RETRYABLE_ERROR_CODES = {
+    APIErrorCode.RateLimited.value,
+    APIErrorCode.InternalServerError.value,
+    APIErrorCode.ServiceUnavailable.value,
+    APIErrorCode.ConflictError.value,
+    "gateway_timeout",
+}
+# Endpoints that write something new on every request: one the server may
+# have processed before failing is not retried, or it would be written twice
+NON_IDEMPOTENT_ENDPOINTS = {"blocks.children.append", "pages.create", "file_uploads.create"}
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread calling the API with the same integration.
+    acquire() blocks until a token is available; pause() stops every caller,
+    which is how a Retry-After from one request is honored by all of them.
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, burst=BURST_SIZE):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        """Number of callers currently waiting for a token."""
+        return self._waiting
+
+    def _reserve(self):
+        """Take a token if there is one and return 0, else return how long to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._paused_until > now:
+                return self._paused_until - now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        with self._lock:
+            self._waiting += 1
+        try:
+            while (delay := self._reserve()) > 0:
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    async def acquire_async(self):
+        """acquire() for coroutines: waits without blocking the event loop."""
+        with self._lock:
+            self._waiting += 1
+        try:
+            while (delay := self._reserve()) > 0:
+                await asyncio.sleep(delay)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + seconds)
+            # Start again from an empty bucket so callers don't burst right after the pause
+            self._tokens = 0
+
+
+def retry_after_seconds(error):
+    """Return the Retry-After delay of a rate limited response, if any."""
+    headers = getattr(error, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def was_not_sent(error):
+    """Whether a request failed before reaching the server: no connection could be opened for it."""
+    # The Notion client replaces the httpx timeouts with a RequestTimeoutError
+    cause = error.__context__ if isinstance(error, RequestTimeoutError) else error
+    return isinstance(cause, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def is_retryable(error, endpoint=None):
+    if endpoint in NON_IDEMPOTENT_ENDPOINTS:
+        # Only the failures the server rejected or never saw: a timeout or a
+        # server error may come after the request was processed
+        return was_not_sent(error) or getattr(error, "code", None) == APIErrorCode.RateLimited.value
+    if isinstance(error, (RequestTimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, HTTPResponseError):
+        return error.code in RETRYABLE_ERROR_CODES or getattr(error, "status", 0) >= 500
+    return False
+
+
+def backoff_delay(attempt):
+    """Full jitter exponential backoff."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class RateLimitedClient:
+    """
+    Wraps a notion_client.Client so that every endpoint call goes through the
+    rate limiter and is retried on rate limits and transient errors.
+    Endpoints are accessed exactly like on the wrapped client,
+    e.g. notion.blocks.children.append(block_id=..., children=...).
+    With an ApiMetrics, every request sent, retries included, is recorded
+    under the name of its endpoint, e.g. blocks.children.append.
+    """
+
+    def __init__(self, client, limiter=None, max_retries=MAX_RETRIES, metrics=None):
+        self.client = client
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.metrics = metrics
+
+    @property
+    def queue_depth(self):
+        return self.limiter.queue_depth
+
+    def call(self, function, *args, **kwargs):
+        return self._call(function.__qualname__, function, args, kwargs)
+
+    def _call(self, endpoint, function, args, kwargs):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = function(*args, **kwargs)
+                self._record(endpoint, 200, attempt, started, kwargs, response)
+                return response
+            except Exception as error:
+                self._record(endpoint, getattr(error, "status", None) or type(error).__name__,
+                             attempt, started, kwargs)
+                delay = self._retry_delay(endpoint, error, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+
+    def _retry_delay(self, endpoint, error, attempt):
+        """Seconds to wait before retrying a failed request, None when it must not be retried."""
+        if not is_retryable(error, endpoint) or attempt >= self.max_retries:
+            return None
+        delay = retry_after_seconds(error)
+        if delay is not None:
+            # The limit is per integration: hold back every caller, not only this one
+            self.limiter.pause(delay)
+        else:
+            delay = backoff_delay(attempt)
+        logging.warning(
+            f"{getattr(error, 'code', type(error).__name__)} on {endpoint}, "
+            f"retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        return delay
+
+    def _record(self, endpoint, status, attempt, started, kwargs, response=None):
+        count_request()
+        if self.metrics is None:
+            return
+        self.metrics.record(endpoint, status, attempt, time.monotonic() - started,
+                            json_size(kwargs), json_size(response) if response is not None else 0)
+
+    def close(self):
+        """Close the connection pool of the wrapped client."""
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            close()
+
+    def __getattr__(self, name):
+        return _wrap(self, getattr(self.client, name), name)
+
+
+class AsyncRateLimitedClient(RateLimitedClient):
+    """
+    RateLimitedClient for a notion_client.AsyncClient: endpoint calls return
+    coroutines, e.g. await notion.pages.update(page_id=..., properties=...).
+    Waiting for a token or a retry does not block the event loop, so many
+    requests can be in flight on one loop. The limiter can be shared with
+    the blocking clients of the same integration.
+    """
+
+    async def call(self, function, *args, **kwargs):
+        return await self._call(function.__qualname__, function, args, kwargs)
+
+    async def _call(self, endpoint, function, args, kwargs):
+        attempt = 0
+        while True:
+            await self.limiter.acquire_async()
+            started = time.monotonic()
+            try:
+                response = await function(*args, **kwargs)
+                self._record(endpoint, 200, attempt, started, kwargs, response)
+                return response
+            except Exception as error:
+                self._record(endpoint, getattr(error, "status", None) or type(error).__name__,
+                             attempt, started, kwargs)
+                delay = self._retry_delay(endpoint, error, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class EventLoopClient(RateLimitedClient):
+    """
+    Blocking client sending its requests from one event loop, run by a
+    background thread, through a notion_client.AsyncClient. It is used like a
+    RateLimitedClient, from any number of threads: their requests are all in
+    flight on the loop and share the connection pool of the AsyncClient.
+    """
+
+    def __init__(self, client, limiter=None, max_retries=MAX_RETRIES, metrics=None):
+        super().__init__(client, limiter=limiter, max_retries=max_retries, metrics=metrics)
+        self.async_client = AsyncRateLimitedClient(
+            client, limiter=self.limiter, max_retries=max_retries, metrics=metrics)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="notion-event-loop", daemon=True)
+        self._thread.start()
+
+    def _call(self, endpoint, function, args, kwargs):
+        # Run the request in the context of the caller, so its metrics are attributed to the caller's page
+        context = contextvars.copy_context()
+
+        async def send():
+            return await asyncio.get_running_loop().create_task(
+                self.async_client._call(endpoint, function, args, kwargs), context=context)
+        return asyncio.run_coroutine_threadsafe(send(), self.loop).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.async_client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class _Endpoint:
+    def __init__(self, owner, endpoint, name):
+        self._owner = owner
+        self._endpoint = endpoint
+        self._name = name
+
+    def __getattr__(self, name):
+        return _wrap(self._owner, getattr(self._endpoint, name), f"{self._name}.{name}")
+
+
+def _wrap(owner, attribute, name):
+    if inspect.ismethod(attribute):
+        def call(*args, **kwargs):
+            return owner._call(name, attribute, args, kwargs)
+        call.__qualname__ = attribute.__qualname__
+        return call
+    if isinstance(attribute, Endpoint):
+        return _Endpoint(owner, attribute, name)
+    return attribute
+
+
+def http_client(asynchronous=False, http2=False, max_connections=MAX_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS, timeout=READ_TIMEOUT_SECONDS):
+    """
+    httpx client keeping a pool of connections alive between requests, so
+    that they don't each pay for a TCP and TLS handshake. http2 multiplexes
+    the requests over fewer connections and needs the h2 package
+    (pip install httpx[http2]).
+    """
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_connections,
+                          keepalive_expiry=keepalive_expiry)
+    timeouts = httpx.Timeout(timeout, connect=CONNECT_TIMEOUT_SECONDS)
+    client_class = httpx.AsyncClient if asynchronous else httpx.Client
+    return client_class(http2=http2, limits=limits, timeout=timeouts)
+
+
+def build_notion_client(auth, http):
+    client_class = AsyncClient if isinstance(http, httpx.AsyncClient) else Client
+    timeouts = http.timeout
+    # RateLimitedClient retries itself, under the shared limiter and in the metrics
+    client = client_class(client=http, auth=auth, retry=False)
+    # The Notion client replaces the timeouts of http with a single one
+    http.timeout = timeouts
+    return client
+
+
+def create_client(auth, limiter=None, metrics=None, event_loop=False, **transport):
+    """
+    Build the rate limited Notion client used by the migration scripts.
+    With event_loop, its requests are sent by an AsyncClient on one event loop
+    (see EventLoopClient). transport are the options of http_client().
+    """
+    if event_loop:
+        http = http_client(asynchronous=True, **transport)
+        return EventLoopClient(build_notion_client(auth, http), limiter=limiter, metrics=metrics)
+    return RateLimitedClient(build_notion_client(auth, http_client(**transport)),
+                             limiter=limiter, metrics=metrics)
+
+
+def create_async_client(auth, limiter=None, metrics=None, **transport):
+    """Build a rate limited Notion client for coroutines, see AsyncRateLimitedClient."""
+    http = http_client(asynchronous=True, **transport)
+    return AsyncRateLimitedClient(build_notion_client(auth, http), limiter=limiter, metrics=metrics)
+
+
+def add_transport_arguments(parser):
+    """Command line options of the HTTP transport, passed to create_client with transport_options()."""
+    parser.add_argument("--http2", action="store_true",
+                        help="send the requests over HTTP/2, needs the h2 package")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="size of the pool of connections kept alive to the API")
+    parser.add_argument("--keepalive-expiry", type=float, default=KEEPALIVE_EXPIRY_SECONDS,
+                        help="seconds an idle connection is kept open for the next requests")
+    parser.add_argument("--timeout", type=float, default=READ_TIMEOUT_SECONDS,
+                        help="seconds to wait for a response or a free connection")
+    parser.add_argument("--async", dest="event_loop", action="store_true",
+                        help="send the requests from one event loop through an async client")
+
+
+def transport_options(args):
+    return {"http2": args.http2, "max_connections": args.max_connections,
+            "keepalive_expiry": args.keepalive_expiry, "timeout": args.timeout}
@@ -1,10 +1,18 @@
-from notion_client.helpers import collect_paginated_api
+from notion_client.helpers import async_collect_paginated_api, collect_paginated_api
+import argparse
+import asyncio
 import os
 import logging
-from notion_client import Client
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from notion_api import add_transport_arguments, create_async_client, create_client, transport_options
+from people_index import PeopleIndex
 from pprint import pprint
 from notion_client import APIErrorCode, APIResponseError
 
+# Number of updates sent at the same time
+UPDATE_WORKERS = 4
+
 
 def getOwnerFromOldDb(ownerId):
     try:
@@ -30,59 +38,139 @@ def getOwnerFromOldDb(ownerId):
             logging.error(error)
 
 
-try:
-    notion = Client(
-        auth="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")
-    # Tech notes : ab4ac06a5b6b45ed951df04307a90663
-    # Doc tech 7c572848e4f04761b659c8f14c6d516e
-    # Test db 1818f3776f4f80158a6ac3fd054fc9c5
-    # All theodoers e2fa07c0424b473f994f176a636bec2a
-    # Sicariotes (old) b970458a757d41238e5d892713d2981f
-    technotes = collect_paginated_api(
-        notion.databases.query, database_id="ab4ac06a5b6b45ed951df04307a90663"
-    )
-    for note in technotes:
-        # Print note name
-        print(note.get("properties").get("Name").get(
-            "title")[0].get("plain_text"))
-        currentExperts = note.get("properties").get("Experts").get("people")
-        expertEmails = []
-        for expert in currentExperts:
-            if expert.get("person") is None:
-                print("no email")
-            else:
-                expertEmails.append(expert.get("person").get("email"))
-                print(expert.get("person").get("email"))
-        # Update page properties`New Experts`
-        newExpertsId = []
-        for email in expertEmails:
-            expert = notion.databases.query(
-                **{
-                    "database_id": "e2fa07c0424b473f994f176a636bec2a",
-                    "filter": {
-                        "property": "⚙️ Email",
-                        "rich_text": {
-                            "contains": email,
-                        },
-                    },
-                }
-            )
-            if expert.get("results") == [] or len(expert.get("results")) > 1:
-                print("Expert not found")
-            else:
-                print("Expert found")
-                expert_id = expert.get("results")[0].get("id")
-                newExpertsId.append({"id": expert_id})
-        # Add new experts to the note
-        if len(newExpertsId) == 0:
-            print("no experts")
+def getNewExperts(note, summary):
+    """Relation of a tech note to the people pages of its Experts."""
+    # Print note name
+    print(note.get("properties").get("Name").get(
+        "title")[0].get("plain_text"))
+    currentExperts = note.get("properties").get("Experts").get("people")
+    expertEmails = []
+    for expert in currentExperts:
+        if expert.get("person") is None:
+            print("no email")
+        else:
+            expertEmails.append(expert.get("person").get("email"))
+            print(expert.get("person").get("email"))
+    newExpertsId = []
+    for email in expertEmails:
+        expert_id = people.resolve(email)
+        if expert_id is None:
+            print("Expert not found")
+            logging.warning(f"Expert {email} of {note.get('id')} not found")
+            summary["experts not found"] += 1
         else:
-            notion.pages.update(
+            print("Expert found")
+            newExpertsId.append({"id": expert_id})
+    return newExpertsId
+
+
+def relationIds(relation):
+    return {item.get("id").replace("-", "") for item in relation}
+
+
+def planUpdate(note, summary):
+    """New Experts relation to write to a note, None when there is nothing to write."""
+    newExpertsId = getNewExperts(note, summary)
+    if len(newExpertsId) == 0:
+        print("no experts")
+        summary["unresolved" if note.get("properties").get("Experts").get("people") else "no experts"] += 1
+        return None
+    currentRelation = note.get("properties").get("New Experts", {})
+    # The query truncates relations of more than 25 pages: those can't be compared
+    if not currentRelation.get("has_more") and \
+            relationIds(currentRelation.get("relation", [])) == relationIds(newExpertsId):
+        print("Experts up to date")
+        summary["skipped"] += 1
+        return None
+    return newExpertsId
+
+
+def updateExperts(note, newExpertsId):
+    try:
+        notion.pages.update(
+            page_id=note.get("id"),
+            properties={
+                "New Experts": {"relation": newExpertsId},
+            })
+        print("Experts updated")
+        return "updated"
+    except APIResponseError as error:
+        logging.error(error)
+        return "failed"
+
+
+async def updateExpertsAsync(asyncNotion, databaseId, summary):
+    """
+    The updates of the loop below, sent from one event loop: they are all in
+    flight at once, within the rate limit, over the connections of one client.
+    """
+    async def update(note, newExpertsId):
+        try:
+            await asyncNotion.pages.update(
                 page_id=note.get("id"),
                 properties={
                     "New Experts": {"relation": newExpertsId},
                 })
             print("Experts updated")
+            return "updated"
+        except APIResponseError as error:
+            logging.error(error)
+            return "failed"
+
+    try:
+        technotes = await async_collect_paginated_api(
+            asyncNotion.databases.query, database_id=databaseId)
+        updates = []
+        for note in technotes:
+            newExpertsId = planUpdate(note, summary)
+            if newExpertsId is not None:
+                updates.append(update(note, newExpertsId))
+        summary.update(await asyncio.gather(*updates))
+    finally:
+        await asyncNotion.aclose()
+
+
+def printSummary(summary):
+    print(f"Tech notes: {summary['updated']} updated, {summary['skipped']} skipped as up to date, "
+          f"{summary['unresolved']} unresolved, {summary['no experts']} without experts, "
+          f"{summary['failed']} failed ({summary['experts not found']} experts not found)")
+
+
+parser = argparse.ArgumentParser(
+    description="Link the tech notes to the people pages of their experts")
+add_transport_arguments(parser)
+args = parser.parse_args()
+
+summary = Counter()
+try:
+    notion = create_client(
+        auth="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", **transport_options(args))
+    # Tech notes : ab4ac06a5b6b45ed951df04307a90663
+    # Doc tech 7c572848e4f04761b659c8f14c6d516e
+    # Test db 1818f3776f4f80158a6ac3fd054fc9c5
+    # All theodoers e2fa07c0424b473f994f176a636bec2a
+    # Sicariotes (old) b970458a757d41238e5d892713d2981f
+    people = PeopleIndex.load(
+        notion, snapshot_path=os.environ.get("PEOPLE_INDEX_SNAPSHOT"))
+    if args.event_loop:
+        # Same integration, same rate limit
+        asyncio.run(updateExpertsAsync(
+            create_async_client(auth="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",
+                                limiter=notion.limiter, **transport_options(args)),
+            "ab4ac06a5b6b45ed951df04307a90663", summary))
+    else:
+        technotes = collect_paginated_api(
+            notion.databases.query, database_id="ab4ac06a5b6b45ed951df04307a90663"
+        )
+        # Update page properties`New Experts`, only where it changes
+        updates = []
+        for note in technotes:
+            newExpertsId = planUpdate(note, summary)
+            if newExpertsId is not None:
+                updates.append((note, newExpertsId))
+        # The rate limiter paces the workers
+        with ThreadPoolExecutor(max_workers=UPDATE_WORKERS) as executor:
+            summary.update(executor.map(lambda update: updateExperts(*update), updates))
 
         # if len(currentOwner) == 0:
         #     print("no owner " + note.get("properties").get("Name").get("title")
@@ -122,3 +210,5 @@ except APIResponseError as error:
     else:
         # Other error handling code
         logging.error(error)
+finally:
+    printSummary(summary)
@@ -0,0 +1,47 @@
+import json
+
+# Notion limits for a single pages.create or blocks.children.append
+# Elements of any array, including each children array
+MAX_BLOCKS_PER_PAGE = 100
+# Blocks in the whole request, nested ones included
+MAX_BLOCKS_PER_REQUEST = 1000
+# Size of the request body, with some room left for the page properties
+MAX_PAYLOAD_BYTES = 450 * 1000
+
+
+def block_count(block):
+    """Number of blocks sent with this block: itself and its nested children."""
+    content = block.get(block.get("type"))
+    children = content.get("children", []) if isinstance(content, dict) else []
+    return 1 + sum(block_count(child) for child in children)
+
+
+def payload_size(block):
+    return len(json.dumps(block, ensure_ascii=False).encode())
+
+
+def pack_blocks(blocks, first_index=0):
+    """
+    Split blocks into batches as large as a single request allows: at most
+    MAX_BLOCKS_PER_PAGE blocks, MAX_BLOCKS_PER_REQUEST blocks counting the
+    nested ones and MAX_PAYLOAD_BYTES of JSON per batch.
+    Yields (index of the first block of the batch, batch).
+    """
+    batch = []
+    batch_start = first_index
+    batch_blocks = 0
+    batch_bytes = 0
+    for index, block in enumerate(blocks, first_index):
+        count = block_count(block)
+        size = payload_size(block)
+        if batch and (len(batch) == MAX_BLOCKS_PER_PAGE
+                      or batch_blocks + count > MAX_BLOCKS_PER_REQUEST
+                      or batch_bytes + size > MAX_PAYLOAD_BYTES):
+            yield batch_start, batch
+            batch, batch_start, batch_blocks, batch_bytes = [], index, 0, 0
+        batch.append(block)
+        batch_blocks += count
+        batch_bytes += size
+    if batch:
+        yield batch_start, batch
+
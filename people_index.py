@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+from notion_client.helpers import collect_paginated_api
+
+# All theodoers
+PEOPLE_DATABASE_ID = "e2fa07c0424b473f994f176a636bec2a"
+EMAIL_PROPERTY = "⚙️ Email"
+
+
+def get_email(person_page):
+    """Read the email of a page of the people database, or None if it has none."""
+    prop = person_page.get("properties", {}).get(EMAIL_PROPERTY)
+    if not prop:
+        return None
+    value = prop.get(prop.get("type"))
+    if isinstance(value, list):
+        value = "".join(text.get("plain_text", "") for text in value)
+    if not value:
+        return None
+    return value.strip()
+
+
+class PeopleIndex:
+    """
+    In-memory email -> page id index of the people database, loaded with one
+    paginated query instead of one filtered query per lookup.
+    """
+
+    def __init__(self):
+        self.by_email = {}
+        self.by_folded_email = {}
+
+    def add(self, email, page_id):
+        ids = self.by_email.setdefault(email, [])
+        if page_id not in ids:
+            ids.append(page_id)
+        folded_ids = self.by_folded_email.setdefault(email.casefold(), [])
+        if page_id not in folded_ids:
+            folded_ids.append(page_id)
+
+    def __len__(self):
+        return len(self.by_email)
+
+    def find(self, email):
+        """
+        Return every page id registered with this email.
+        Exact matches win, otherwise the lookup is case-insensitive.
+        """
+        email = email.strip()
+        if email in self.by_email:
+            return list(self.by_email[email])
+        return list(self.by_folded_email.get(email.casefold(), []))
+
+    def resolve(self, email):
+        """Return the page id of the person with this email, None if unknown or ambiguous."""
+        ids = self.find(email)
+        if len(ids) > 1:
+            logging.warning(f"{email} matches {len(ids)} people: {ids}")
+            return None
+        return ids[0] if ids else None
+
+    def save(self, path):
+        with open(path, "w") as snapshot:
+            json.dump(self.by_email, snapshot)
+
+    @classmethod
+    def from_snapshot(cls, path):
+        index = cls()
+        with open(path) as snapshot:
+            for email, ids in json.load(snapshot).items():
+                for page_id in ids:
+                    index.add(email, page_id)
+        return index
+
+    @classmethod
+    def load(cls, notion, database_id=PEOPLE_DATABASE_ID, snapshot_path=None, refresh=False):
+        """
+        Paginate the people database once and index it by email.
+        If snapshot_path is given, the index is read from it when it exists
+        (unless refresh is set) and written to it after a fresh load.
+        """
+        if snapshot_path and os.path.exists(snapshot_path) and not refresh:
+            index = cls.from_snapshot(snapshot_path)
+            print(f"Loaded {len(index)} people from {snapshot_path}")
+            return index
+        index = cls()
+        for person in collect_paginated_api(notion.databases.query, database_id=database_id):
+            email = get_email(person)
+            if email:
+                index.add(email, person.get("id"))
+        print(f"Indexed {len(index)} people")
+        if snapshot_path:
+            index.save(snapshot_path)
+        return index
@@ -0,0 +1,127 @@
+import queue
+import threading
+
+# Items waiting between two stages. Keeps at most a few page trees in memory.
+PIPELINE_QUEUE_SIZE = 2
+# How often blocked stages check whether the pipeline was stopped
+POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+class InFlightLimit:
+    """
+    Soft cap on the blocks held in memory by the items between two stages,
+    typically from the fetch of a page tree until its write.
+    wait_for_room() blocks while the cap is reached; an item is then added
+    with its size and released by a later stage. A single item larger than
+    the cap still goes through, alone.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+        self._items = {}
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def wait_for_room(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or self.count < self.limit)
+
+    def add(self, key, size):
+        with self._condition:
+            self._items[key] = self._items.get(key, 0) + size
+            self.count += size
+
+    def release(self, key):
+        with self._condition:
+            self.count -= self._items.pop(key, 0)
+            self._condition.notify_all()
+
+    def close(self):
+        """Stop blocking the waiting callers, once the stage that releases is gone."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+def run_pipeline(items, stages, queue_size=PIPELINE_QUEUE_SIZE, in_flight=None):
+    """
+    Run every item through stages, a list of functions each taking the output
+    of the previous one. Each stage runs on its own thread and the stages are
+    connected by bounded queues: while the last stage works on item N, the
+    first ones already work on items N+1, N+2... and a slow stage makes the
+    others wait instead of piling up items in memory.
+    A stage returning None drops the item.
+    Returns the outputs of the last stage, in order. The first exception raised
+    by a stage (or by iterating items) stops the pipeline and is raised again here.
+    in_flight, the InFlightLimit the stages use, is closed when the pipeline stops
+    so that no stage waits for a release that will never come.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    stop = threading.Event()
+    errors = []
+    results = []
+
+    def fail(error):
+        errors.append(error)
+        stop.set()
+        if in_flight is not None:
+            in_flight.close()
+
+    def put(outbox, item):
+        while not stop.is_set():
+            try:
+                outbox.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed():
+        try:
+            for item in items:
+                if not put(queues[0], item):
+                    return
+        except BaseException as error:
+            fail(error)
+            return
+        put(queues[0], _DONE)
+
+    def work(stage, inbox, outbox):
+        while True:
+            try:
+                item = inbox.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            if item is _DONE:
+                if outbox is not None:
+                    put(outbox, _DONE)
+                return
+            try:
+                output = stage(item)
+            except BaseException as error:
+                fail(error)
+                return
+            if output is None:
+                continue
+            if outbox is None:
+                results.append(output)
+            elif not put(outbox, output):
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for i, stage in enumerate(stages):
+        outbox = queues[i + 1] if i + 1 < len(stages) else None
+        threads.append(threading.Thread(
+            target=work, args=(stage, queues[i], outbox), daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,127 @@
+import json
+import math
+
+from packer import MAX_BLOCKS_PER_PAGE, pack_blocks
+
+PLAN_PATH = "migration_plan.json"
+# Number of pages listed as the most expensive ones
+TOP_PAGES = 10
+# file_uploads.create and send of a hosted file: the size of a file is only known once
+# downloaded, the ones over 20 MB take a send per 10 MB part and a complete
+UPLOAD_REQUESTS = 2
+
+
+def children_of(block):
+    content = block.get(block.get("type"))
+    return content.get("children", []) if isinstance(content, dict) else []
+
+
+def fetch_requests(blocks):
+    """blocks.children.list calls needed to fetch a source tree: one per result page of every parent."""
+    requests = max(1, math.ceil(len(blocks) / MAX_BLOCKS_PER_PAGE))
+    for block in blocks:
+        if block.get("has_children"):
+            requests += fetch_requests(children_of(block))
+    return requests
+
+
+def tree_stats(blocks):
+    """(number of blocks, number of levels) of a source tree."""
+    count, depth = len(blocks), 1 if blocks else 0
+    for block in blocks:
+        block_count, block_depth = tree_stats(children_of(block))
+        count += block_count
+        depth = max(depth, block_depth + 1)
+    return count, depth
+
+
+def plan_page(initial_blocks, excess_blocks, deep_blocks, rewritten_blocks=None, files=0):
+    """
+    Requests the write of a prepared page makes, as write_doc sends them:
+    the creation, the appends of the excess blocks and of every deep group,
+    and the listings of the blocks whose children were created inline
+    (see main.append_deep_blocks).
+    A page migrated before and rewritten by a sync, whose target holds
+    rewritten_blocks top level blocks, is updated instead of created: its
+    blocks are listed and deleted, and all of its new blocks appended.
+    files is the number of hosted files copied to the target for the page.
+    """
+    requests = {"create": 1, "update": 0, "delete": 0, "append": 0, "list": 0,
+                "upload": files * UPLOAD_REQUESTS}
+    if rewritten_blocks is not None:
+        requests.update(create=0, update=1, delete=rewritten_blocks,
+                        list=max(1, math.ceil(rewritten_blocks / MAX_BLOCKS_PER_PAGE)))
+        excess_blocks = initial_blocks + excess_blocks
+        initial_blocks = []
+    requests["append"] = sum(1 for _ in pack_blocks(excess_blocks, len(initial_blocks)))
+    for group in deep_blocks.values():
+        requests["append"] += sum(1 for _ in pack_blocks(group))
+    requests["list"] += len({path[:-1] for path in deep_blocks
+                             if len(path) > 1 and path[:-1] not in deep_blocks})
+    return requests
+
+
+class Plan:
+    """Predicted requests of a migration, per page and in total."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.pages = []
+        self.setup_requests = 0
+        self.file_sources = set()
+
+    def add(self, name, source_id, source_stats, fetch, prepared, rewritten_blocks=None, hosted_files=()):
+        """
+        Add a page: the tree_stats of its source tree, taken before the
+        transformation changes it, the requests to fetch it and its prepared
+        blocks. rewritten_blocks is given for a page a sync rewrites, see
+        plan_page. hosted_files are the source files of its file blocks: each
+        is uploaded once for the whole migration.
+        """
+        initial_blocks, excess_blocks, deep_blocks = prepared
+        block_count, depth = source_stats
+        files = set(hosted_files) - self.file_sources
+        self.file_sources |= files
+        requests = plan_page(initial_blocks, excess_blocks, deep_blocks, rewritten_blocks, len(files))
+        requests["fetch"] = fetch
+        self.pages.append({
+            "name": name,
+            "id": source_id,
+            "blocks": block_count,
+            "depth": depth,
+            "deep_groups": len(deep_blocks),
+            **requests,
+            "requests": sum(requests.values()),
+            "duration": sum(requests.values()) / self.rate,
+        })
+
+    def totals(self):
+        totals = {key: sum(page[key] for page in self.pages)
+                  for key in ["blocks", "deep_groups", "fetch", "create", "update", "delete", "append", "list", "upload"]}
+        totals["pages"] = len(self.pages)
+        totals["requests"] = sum(page["requests"] for page in self.pages) + self.setup_requests
+        totals["duration"] = totals["requests"] / self.rate
+        return totals
+
+    def report(self):
+        """Text report: totals and the pages that cost the most requests."""
+        totals = self.totals()
+        lines = [f"{'page':<40} {'blocks':>7} {'depth':>6} {'fetch':>6} {'create':>7} {'update':>7} "
+                 f"{'delete':>7} {'append':>7} {'list':>5} {'upload':>7} {'requests':>9} {'time (s)':>9}"]
+        for page in sorted(self.pages, key=lambda page: page["requests"], reverse=True)[:TOP_PAGES]:
+            lines.append(
+                f"{page['name'][:40]:<40} {page['blocks']:>7} {page['depth']:>6} {page['fetch']:>6} "
+                f"{page['create']:>7} {page['update']:>7} {page['delete']:>7} {page['append']:>7} "
+                f"{page['list']:>5} {page['upload']:>7} {page['requests']:>9} {page['duration']:>9.0f}")
+        lines.append(
+            f"{'Total, ' + str(totals['pages']) + ' pages':<40} {totals['blocks']:>7} {'':>6} "
+            f"{totals['fetch']:>6} {totals['create']:>7} {totals['update']:>7} {totals['delete']:>7} "
+            f"{totals['append']:>7} {totals['list']:>5} {totals['upload']:>7} {totals['requests']:>9} "
+            f"{totals['duration']:>9.0f}")
+        lines.append(f"Expected duration at {self.rate:g} requests per second: "
+                     f"{totals['duration'] / 3600:.1f} h")
+        return "\n".join(lines)
+
+    def write(self, path=PLAN_PATH):
+        with open(path, "w") as plan:
+            json.dump({"rate": self.rate, "totals": self.totals(), "pages": self.pages}, plan, indent=2)
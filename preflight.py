@@ -0,0 +1,182 @@
+import copy
+import logging
+
+# Documented limits of the Notion API on the content of a request
+MAX_RICH_TEXT_LENGTH = 2000
+MAX_RICH_TEXT_ITEMS = 100
+MAX_URL_LENGTH = 2000
+MAX_EQUATION_LENGTH = 1000
+# Keys of a block content holding a rich text array
+RICH_TEXT_KEYS = ["rich_text", "caption"]
+
+
+def text_content(item):
+    """Content of a text item of a rich text array, None for mentions and equations."""
+    if item.get("type", "text") != "text" or "text" not in item:
+        return None
+    return item["text"].get("content") or ""
+
+
+def same_style(item, other):
+    return (text_content(item) is not None and text_content(other) is not None
+            and item.get("annotations") == other.get("annotations")
+            and item["text"].get("link") == other["text"].get("link"))
+
+
+def split_text_item(item):
+    """Split a text item into items of at most MAX_RICH_TEXT_LENGTH characters, in the same style."""
+    content = text_content(item)
+    pieces = []
+    for start in range(0, len(content), MAX_RICH_TEXT_LENGTH):
+        piece = copy.deepcopy(item)
+        piece["text"]["content"] = content[start:start + MAX_RICH_TEXT_LENGTH]
+        piece.pop("plain_text", None)
+        pieces.append(piece)
+    return pieces
+
+
+def merge_text_items(rich_text):
+    """Merge neighbour text items of the same style, as long as the result stays under the length limit."""
+    merged = []
+    for item in rich_text:
+        previous = merged[-1] if merged else None
+        if previous is not None and same_style(previous, item) and \
+                len(text_content(previous)) + len(text_content(item)) <= MAX_RICH_TEXT_LENGTH:
+            previous["text"]["content"] += text_content(item)
+            previous.pop("plain_text", None)
+            continue
+        merged.append(copy.deepcopy(item))
+    return merged
+
+
+def fix_rich_text(rich_text, fixes, location):
+    """
+    Return rich_text with every item within the limits: texts over
+    MAX_RICH_TEXT_LENGTH characters split in several items, links and equations
+    over their limit turned into plain text, and items merged when the array is
+    longer than MAX_RICH_TEXT_ITEMS. The array can still be too long when its
+    items cannot be merged: the caller decides what to do with the rest.
+    Each rewrite is described in fixes.
+    """
+    fixed = []
+    for item in rich_text:
+        content = text_content(item)
+        if item.get("type") == "equation":
+            expression = item["equation"].get("expression", "")
+            if len(expression) > MAX_EQUATION_LENGTH:
+                fixes.append(f"{location}: equation of {len(expression)} characters written as text")
+                item = {"type": "text", "text": {"content": expression},
+                        "annotations": {**item.get("annotations", {}), "code": True}}
+                content = expression
+        if content is None:
+            fixed.append(item)
+            continue
+        link = item["text"].get("link")
+        if link and len(link.get("url") or "") > MAX_URL_LENGTH:
+            fixes.append(f"{location}: link over {MAX_URL_LENGTH} characters removed")
+            item = copy.deepcopy(item)
+            item["text"]["link"] = None
+            item.pop("href", None)
+        if len(content) > MAX_RICH_TEXT_LENGTH:
+            fixes.append(f"{location}: text of {len(content)} characters split")
+            fixed.extend(split_text_item(item))
+        else:
+            fixed.append(item)
+    if len(fixed) > MAX_RICH_TEXT_ITEMS:
+        fixes.append(f"{location}: {len(fixed)} items merged")
+        fixed = merge_text_items(fixed)
+    return fixed
+
+
+def fix_content(block, fixes, location="block"):
+    """Fix the rich text arrays of a block in place, leaving rich_text possibly too long."""
+    block_type = block.get("type")
+    content = block.get(block_type)
+    if not isinstance(content, dict):
+        return
+    for key in RICH_TEXT_KEYS:
+        if content.get(key):
+            content[key] = fix_rich_text(content[key], fixes, f"{location}.{block_type}.{key}")
+    if content.get("caption"):
+        content["caption"] = truncate(content["caption"], fixes, f"{location}.{block_type}.caption")
+    if block_type == "table_row":
+        cells = []
+        for i, cell in enumerate(content.get("cells", [])):
+            cell_location = f"{location}.table_row.cells[{i}]"
+            cells.append(truncate(fix_rich_text(cell, fixes, cell_location), fixes, cell_location))
+        content["cells"] = cells
+
+
+def fix_block(block, fixes, location="block"):
+    """
+    Bring the rich text of a block within the limits. Blocks whose text still
+    has more than MAX_RICH_TEXT_ITEMS items are continued in new blocks of the
+    same type, so this returns the list of blocks to write in place of block.
+    """
+    fix_content(block, fixes, location)
+    block_type = block.get("type")
+    content = block.get(block_type)
+    if not isinstance(content, dict) or len(content.get("rich_text") or []) <= MAX_RICH_TEXT_ITEMS:
+        return [block]
+    rich_text = content["rich_text"]
+    fixes.append(f"{location}.{block_type}: continued in "
+                 f"{(len(rich_text) - 1) // MAX_RICH_TEXT_ITEMS} more block(s)")
+    content["rich_text"] = rich_text[:MAX_RICH_TEXT_ITEMS]
+    blocks = [block]
+    for start in range(MAX_RICH_TEXT_ITEMS, len(rich_text), MAX_RICH_TEXT_ITEMS):
+        continued = {key: value for key, value in content.items()
+                     if key not in ("rich_text", "children", "caption")}
+        continued["rich_text"] = rich_text[start:start + MAX_RICH_TEXT_ITEMS]
+        blocks.append({"object": "block", "type": block_type, block_type: continued})
+    return blocks
+
+
+def truncate(rich_text, fixes, location):
+    if len(rich_text) <= MAX_RICH_TEXT_ITEMS:
+        return rich_text
+    fixes.append(f"{location}: {len(rich_text) - MAX_RICH_TEXT_ITEMS} items over the limit dropped")
+    return rich_text[:MAX_RICH_TEXT_ITEMS]
+
+
+def check_payload(children, location="body.children"):
+    """
+    Last check of the blocks of a create or append request, nested ones
+    included, before sending it. Rich text is fixed in place: the position of
+    the blocks is already decided, so items that cannot fit are dropped
+    instead of continued in new blocks. Returns the description of the rewrites.
+    """
+    fixes = []
+    for i, block in enumerate(children):
+        block_location = f"{location}[{i}]"
+        fix_content(block, fixes, block_location)
+        block_type = block.get("type")
+        content = block.get(block_type)
+        if not isinstance(content, dict):
+            continue
+        if content.get("rich_text"):
+            content["rich_text"] = truncate(
+                content["rich_text"], fixes, f"{block_location}.{block_type}.rich_text")
+        if content.get("children"):
+            fixes.extend(check_payload(
+                content["children"], f"{block_location}.{block_type}.children"))
+    return fixes
+
+
+def check_properties(properties):
+    """Fix the title and rich text properties of a create or update request in place."""
+    fixes = []
+    for name, prop in properties.items():
+        for key in ("title", "rich_text"):
+            if prop.get(key):
+                location = f"body.properties.{name}.{key}"
+                prop[key] = truncate(fix_rich_text(prop[key], fixes, location), fixes, location)
+    return fixes
+
+
+def report(fixes, what):
+    """Log the rewrites made by the pre-flight check of a request."""
+    if not fixes:
+        return
+    print(f"Pre-flight rewrote {len(fixes)} value(s) of {what}")
+    for fix in fixes:
+        logging.warning(f"Pre-flight: {fix}")
@@ -0,0 +1,215 @@
+import hashlib
+import logging
+import mimetypes
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import datetime, timezone
+from urllib.parse import unquote, urlsplit
+
+import httpx
+
+from transform import FILE_BLOCK_TYPES
+
+# Number of files downloaded and uploaded at the same time
+TRANSFER_WORKERS = 4
+# Files up to this size are sent in a single request, larger ones in parts
+MAX_SINGLE_PART_BYTES = 20 * 1024 * 1024
+PART_BYTES = 10 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+DOWNLOAD_TIMEOUT_SECONDS = 60
+
+
+def hosted_file_blocks(blocks):
+    """Yield the blocks of a tree whose file is hosted by Notion."""
+    for block in blocks:
+        block_type = block.get("type")
+        content = block.get(block_type)
+        if not isinstance(content, dict):
+            continue
+        if block_type in FILE_BLOCK_TYPES and content.get("type") == "file":
+            yield block
+        if content.get("children"):
+            yield from hosted_file_blocks(content["children"])
+
+
+def has_expired(expiry_time):
+    """Whether the expiry_time of a signed URL has passed, False when it cannot be read."""
+    try:
+        return datetime.fromisoformat(expiry_time.replace("Z", "+00:00")) <= datetime.now(timezone.utc)
+    except (AttributeError, TypeError, ValueError):
+        return False
+
+
+def source_of(url):
+    # Signed URLs change on every fetch, their path identifies the file
+    return urlsplit(url)._replace(query="").geturl()
+
+
+def file_name(url, content=None):
+    """Name of a hosted file: the name of the block if any, else the last part of its URL."""
+    if content and content.get("name"):
+        return content["name"]
+    return unquote(urlsplit(url).path.rsplit("/", 1)[-1]) or "file"
+
+
+class FileRehoster:
+    """
+    Copy the files hosted by Notion in the source workspace to the target one,
+    through the file upload API, so that file blocks are migrated instead of
+    replaced with a warning.
+    Downloads are streamed to a temporary file while hashing them, then sent
+    in a single request or in parts of PART_BYTES: at most one part of each
+    file is held in memory. Identical files, by content hash or by source
+    file, are uploaded once. http is the client used to download the signed
+    source URLs, any httpx.Client, e.g. one pointing at a local server.
+    Signed URLs expire after about an hour, so the ones read from the block
+    cache or an archive often have: the URL of a block is read again from
+    the source with blocks.retrieve when it has expired or is refused.
+    """
+
+    def __init__(self, notion, http=None, workers=TRANSFER_WORKERS):
+        self.notion = notion
+        self.http = http or httpx.Client(timeout=DOWNLOAD_TIMEOUT_SECONDS, follow_redirects=True)
+        self.by_hash = {}
+        self.by_source = {}
+        self.uploaded = 0
+        self.deduplicated = 0
+        self.failed = 0
+        self.refreshed = 0
+        # Events of the copies in progress, by source file and by content hash
+        self._copying_sources = {}
+        self._copying_hashes = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def rehost_tree(self, blocks):
+        """
+        Point every hosted file block of the tree to a copy uploaded to the
+        target workspace, in place. Blocks whose file cannot be copied are
+        left as they are, the transformation replaces them with a warning.
+        """
+        # Each upload runs in the caller's context, so its requests count for the caller's page and span
+        futures = [(block, self._executor.submit(copy_context().run, self.rehost_block, block))
+                   for block in hosted_file_blocks(blocks)]
+        for block, future in futures:
+            try:
+                future.result()
+            except Exception as error:
+                with self._lock:
+                    self.failed += 1
+                print(f"Could not copy the file of a {block.get('type')} block: {error}")
+                logging.error(f"Failed to copy {block[block.get('type')]['file'].get('url')}: {error}")
+        return blocks
+
+    def rehost_block(self, block):
+        content = block[block.get("type")]
+        url = content["file"]["url"]
+        filename = file_name(url, content)
+        can_refresh = block.get("id") is not None
+        with self._lock:
+            copied = source_of(url) in self.by_source
+        if can_refresh and not copied and has_expired(content["file"].get("expiry_time")):
+            url, can_refresh = self.refresh_url(block), False
+        try:
+            upload_id = self.rehost(url, filename)
+        except httpx.HTTPStatusError as error:
+            if not can_refresh or error.response.status_code != 403:
+                raise
+            upload_id = self.rehost(self.refresh_url(block), filename)
+        content.pop("file")
+        content["type"] = "file_upload"
+        content["file_upload"] = {"id": upload_id}
+
+    def refresh_url(self, block):
+        """Read the file of a source block again, for a new signed URL, and return that URL."""
+        retrieved = self.notion.blocks.retrieve(block_id=block["id"])
+        block[block.get("type")]["file"] = retrieved[retrieved["type"]]["file"]
+        with self._lock:
+            self.refreshed += 1
+        return retrieved[retrieved["type"]]["file"]["url"]
+
+    def _claim(self, copies, in_progress, key):
+        """
+        Return (upload id, None) when the file with key in copies was copied,
+        else (None, event) once the caller is the one to copy it: it must call
+        _release with the event. Waits while another thread copies it.
+        """
+        while True:
+            with self._lock:
+                if key in copies:
+                    self.deduplicated += 1
+                    return copies[key], None
+                event = in_progress.get(key)
+                if event is None:
+                    in_progress[key] = threading.Event()
+                    return None, in_progress[key]
+            # If that copy fails, the next waiter to wake up tries again
+            event.wait()
+
+    def _release(self, in_progress, key, event):
+        with self._lock:
+            in_progress.pop(key, None)
+        event.set()
+
+    def rehost(self, url, filename):
+        """
+        Return the id of an upload holding the file at url, uploading it if
+        not done yet. A file being copied by another thread, by source or by
+        content, is waited for rather than uploaded twice.
+        """
+        source = source_of(url)
+        upload_id, source_claim = self._claim(self.by_source, self._copying_sources, source)
+        if upload_id is not None:
+            return upload_id
+        try:
+            with tempfile.TemporaryFile() as spool:
+                digest = hashlib.sha256()
+                with self.http.stream("GET", url) as response:
+                    response.raise_for_status()
+                    content_type = response.headers.get("content-type", "").split(";")[0] or \
+                        mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                    for chunk in response.iter_bytes(DOWNLOAD_CHUNK_BYTES):
+                        digest.update(chunk)
+                        spool.write(chunk)
+                size = spool.tell()
+                upload_id, hash_claim = self._claim(self.by_hash, self._copying_hashes, digest.hexdigest())
+                if upload_id is not None:
+                    with self._lock:
+                        self.by_source[source] = upload_id
+                    return upload_id
+                try:
+                    spool.seek(0)
+                    upload_id = self.upload(spool, size, filename, content_type)
+                    with self._lock:
+                        self.uploaded += 1
+                        self.by_hash[digest.hexdigest()] = upload_id
+                        self.by_source[source] = upload_id
+                finally:
+                    self._release(self._copying_hashes, digest.hexdigest(), hash_claim)
+            return upload_id
+        finally:
+            self._release(self._copying_sources, source, source_claim)
+
+    def upload(self, spool, size, filename, content_type):
+        if size <= MAX_SINGLE_PART_BYTES:
+            upload = self.notion.file_uploads.create(
+                mode="single_part", filename=filename, content_type=content_type)
+            self.notion.file_uploads.send(
+                file_upload_id=upload["id"], file=(filename, spool.read(), content_type))
+            return upload["id"]
+        parts = -(-size // PART_BYTES)
+        upload = self.notion.file_uploads.create(
+            mode="multi_part", number_of_parts=parts, filename=filename, content_type=content_type)
+        for part_number in range(1, parts + 1):
+            self.notion.file_uploads.send(
+                file_upload_id=upload["id"], file=(filename, spool.read(PART_BYTES), content_type),
+                part_number=str(part_number))
+        self.notion.file_uploads.complete(file_upload_id=upload["id"])
+        return upload["id"]
+
+    def close(self):
+        self._executor.shutdown()
+        print(f"Files copied: {self.uploaded} uploaded, {self.deduplicated} deduplicated, "
+              f"{self.failed} failed, {self.refreshed} expired URLs read again")
@@ -0,0 +1,198 @@
+from notion_client.helpers import iterate_paginated_api
+import argparse
+import contextlib
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import uuid
+from datetime import datetime, timezone
+
+import main as migration
+from api_metrics import ApiMetrics
+from block_cache import BlockCache
+from journal import Journal
+from notion_api import create_client, transport_options
+from people_index import PeopleIndex
+from rehost import FileRehoster
+from tracing import Tracer
+
+# Integration tokens, comma separated, when --tokens-file is not given
+TOKENS_ENV = "NOTION_TOKENS"
+LOG_PATH = "migration.log"
+# How often the coordinator checks whether a worker died without reporting
+POLL_SECONDS = 1
+# Options of main.py the workers do not implement, with their argument name: they only migrate
+UNSUPPORTED_MODES = {"--plan": "plan", "--export": "export", "--import": "import_archive",
+                     "--verify": "verify"}
+
+
+def shard_path(path, shard):
+    """Per shard variant of a file path: migration_journal.jsonl -> migration_journal.shard-0.jsonl"""
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard-{shard}{extension}"
+
+
+def shard_of(doc, shards):
+    """
+    Shard a source page is migrated by. It only depends on the page id, so a
+    rerun with the same number of tokens sends each page to the worker whose
+    journal and cache already know it.
+    """
+    # Recent Notion ids are time ordered: hash them for an even spread
+    digest = hashlib.sha256(uuid.UUID(doc.get("id")).bytes).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def read_tokens(path=None):
+    if path is not None:
+        with open(path) as tokens:
+            return [line.strip() for line in tokens if line.strip()]
+    return [token.strip() for token in os.environ.get(TOKENS_ENV, "").split(",") if token.strip()]
+
+
+def run_worker(shard, token, inbox, events, people, args, log_path):
+    """
+    Worker process: migrate the docs received on inbox, until None, with the
+    integration of token. Each worker has its own rate limit, journal, cache,
+    metrics report and log file. Reports ("page", shard, page id) for every
+    page written, then ("done", shard, pages written, request totals,
+    incomplete pages) or ("error", shard, message).
+    """
+    with open(shard_path(log_path, shard), "a") as log, contextlib.redirect_stdout(log):
+        try:
+            if not args.no_cache:
+                migration.cache = BlockCache(shard_path(args.cache_path, shard))
+            migration.journal = Journal(shard_path(args.journal, shard))
+            migration.sync_mode = args.sync
+            migration.target_database_id = args.target_database
+            migration.metrics = ApiMetrics()
+            if args.trace is not None:
+                migration.tracer = Tracer()
+            migration.notion = create_client(auth=token, metrics=migration.metrics,
+                                             event_loop=args.event_loop, **transport_options(args))
+            migration.people = people
+            if not args.no_rehost_files:
+                migration.rehoster = FileRehoster(migration.notion)
+            if not args.no_dedup:
+                migration.target_index = migration.load_target_index()
+            written = migration.migrate(
+                iter(inbox.get, None),
+                on_page_written=lambda page_id: events.put(("page", shard, page_id)),
+                max_in_flight_blocks=args.max_in_flight_blocks)
+            migration.metrics.write(shard_path(args.metrics_json, shard),
+                                    shard_path(args.metrics_prometheus, shard))
+            if migration.tracer is not None:
+                migration.tracer.write(shard_path(args.trace, shard))
+                print(migration.tracer.report())
+            events.put(("done", shard, len(written), migration.metrics.report()["totals"],
+                        len(migration.incomplete_pages)))
+        except Exception as error:
+            logging.exception(f"Shard {shard} failed")
+            events.put(("error", shard, repr(error)))
+        finally:
+            if migration.journal is not None:
+                migration.journal.close()
+            if migration.cache is not None:
+                migration.cache.close()
+            if migration.rehoster is not None:
+                migration.rehoster.close()
+            if migration.notion is not None:
+                migration.notion.close()
+
+
+def coordinate(tokens, docs, people, args, log_path=LOG_PATH):
+    """
+    Start one worker process per token and give each doc to exactly one of
+    them, as the docs come from the source query: workers start migrating
+    while the coordinator is still paging through the database.
+    Prints the progress of all workers and returns {shard: final event}.
+    """
+    context = multiprocessing.get_context("spawn")
+    events = context.Queue()
+    inboxes = [context.Queue() for _ in tokens]
+    workers = [
+        context.Process(target=run_worker, name=f"shard-{shard}",
+                        args=(shard, token, inboxes[shard], events, people, args, log_path))
+        for shard, token in enumerate(tokens)]
+    for worker in workers:
+        worker.start()
+
+    seen = set()
+    try:
+        for doc in docs:
+            # A page edited while the query pages through the database can be listed twice
+            if doc.get("id") in seen:
+                continue
+            seen.add(doc.get("id"))
+            inboxes[shard_of(doc, len(tokens))].put(doc)
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+    print(f"Sharded {len(seen)} pages across {len(tokens)} workers")
+
+    written = 0
+    finished = {}
+    while len(finished) < len(workers):
+        try:
+            event = events.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            for shard, worker in enumerate(workers):
+                if shard not in finished and not worker.is_alive() and events.empty():
+                    finished[shard] = ("error", shard, f"exited with code {worker.exitcode}")
+            continue
+        if event[0] == "page":
+            written += 1
+            print(f"[{written}/{len(seen)}] shard {event[1]} wrote page {event[2]}")
+        else:
+            finished[event[1]] = event
+    for worker in workers:
+        worker.join()
+
+    for shard, event in sorted(finished.items()):
+        if event[0] == "done":
+            print(f"Shard {shard}: {event[2]} pages, {event[3]['requests']} requests, "
+                  f"{event[3]['retries']} retries, {event[4]} incomplete pages")
+        else:
+            print(f"Shard {shard} failed: {event[2]}")
+    return finished
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Migrate the Doc tech database with one worker process per integration token. "
+        "Other options are the ones of main.py, their files are suffixed with the shard number.")
+    parser.add_argument("--tokens-file",
+                        help=f"file with one integration token per line, defaults to ${TOKENS_ENV}")
+    parser.add_argument("--log", default=LOG_PATH,
+                        help="output of the workers, one file per shard")
+    args, migration_argv = parser.parse_known_args()
+    migration_args = migration.parse_args(migration_argv)
+    for option, dest in UNSUPPORTED_MODES.items():
+        if getattr(migration_args, dest) is not None:
+            parser.error(f"{option} is not supported with shards, run main.py {option}")
+    return args, migration_args
+
+
+if __name__ == "__main__":
+    args, migration_args = parse_args()
+    tokens = read_tokens(args.tokens_file)
+    if not tokens:
+        raise SystemExit(f"No integration token: set {TOKENS_ENV} or pass --tokens-file")
+
+    # The coordinator shares the first integration with shard 0 for the source query
+    migration.notion = create_client(auth=tokens[0], **transport_options(migration_args))
+    people = PeopleIndex.load(
+        migration.notion, snapshot_path=os.environ.get("PEOPLE_INDEX_SNAPSHOT"))
+    since = None
+    if migration_args.sync:
+        sync_started = datetime.now(timezone.utc).replace(
+            second=0, microsecond=0).isoformat()
+        since = migration.load_watermark(migration_args.sync_state)
+        print(f"Syncing pages edited since {since}")
+    docs = iterate_paginated_api(
+        migration.notion.databases.query, **migration.source_query(since))
+    results = coordinate(tokens, docs, people, migration_args, args.log)
+    if migration_args.sync and all(event[0] == "done" and not event[4] for event in results.values()):
+        migration.save_watermark(migration_args.sync_state, sync_started)
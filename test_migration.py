@@ -0,0 +1,216 @@
+"""
+End to end checks of the migration against the local Notion emulator: the
+target tree of every page must match its source once normalized, the way
+main.py --verify compares them. The source trees are read from the emulator
+itself, not with the migration's fetch, so that a fetch bug shows too.
+
+    python -m pytest test_migration.py
+"""
+import contextlib
+import copy
+import io
+import json
+import os
+import random
+
+import httpx
+import pytest
+from notion_client import APIResponseError
+from notion_client.helpers import iterate_paginated_api
+
+import benchmark
+import fake_notion
+import main as migration
+import rehost
+import verify as verifier
+from fake_notion import FakeNotion
+from fingerprint import plain_text, prepared_tree
+from journal import Journal
+from notion_api import RateLimitedClient, RateLimiter
+from people_index import PeopleIndex
+from rehost import FileRehoster
+from transform import FILE_WARNING
+
+
+def paragraph(content):
+    return {"object": "block", "type": "paragraph", "paragraph": {"rich_text": benchmark.text(content)}}
+
+
+def toggle(content, children):
+    return {"object": "block", "type": "toggle", "has_children": True,
+            "toggle": {"rich_text": benchmark.text(content), "children": children}}
+
+
+def hosted_file(block_type, path, signature="1"):
+    return {"object": "block", "type": block_type, block_type: {
+        "type": "file", "caption": [],
+        "file": {"url": f"https://files.test/{path}?signature={signature}",
+                 "expiry_time": "2999-01-01T00:00:00.000Z"}}}
+
+
+@pytest.fixture
+def workspace(monkeypatch, tmp_path):
+    """Emulated workspace seeded like the benchmark, with main.py set up to migrate it with a journal."""
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+    # Rate limited answers are retried right away: the retries are exercised, not waited for
+    fake = FakeNotion(rate_limit_probability=0.05, retry_after=0, seed=0)
+    monkeypatch.setattr(migration, "notion", RateLimitedClient(
+        fake, limiter=RateLimiter(rate=10 ** 6, burst=10 ** 6)))
+    monkeypatch.setattr(migration, "journal", Journal(str(tmp_path / "journal.jsonl")))
+    for name in ["cache", "metrics", "people", "rehoster", "target_index", "tracer"]:
+        monkeypatch.setattr(migration, name, None)
+    monkeypatch.setattr(migration, "incomplete_pages", [])
+    monkeypatch.setattr(migration, "target_database_id", migration.TARGET_DATABASE_ID)
+    yield fake
+    migration.journal.close()
+
+
+def run(function, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args)
+
+
+def seed(fake, pages, depth):
+    benchmark.build_workspace(fake, random.Random(depth), pages, depth)
+    migration.people = run(PeopleIndex.load, migration.notion)
+
+
+def add_page(fake, name, blocks):
+    with open(benchmark.SAMPLE_PROPERTIES) as sample:
+        properties = benchmark.synthetic_properties(json.load(sample), name, "person0@theodo.com")
+    return fake.add_page(migration.SOURCE_DATABASE_ID, properties, blocks)
+
+
+def source_tree(fake, block_id):
+    """Block tree under block_id as stored by the emulator, children nested like get_all_children does."""
+    blocks = []
+    for child_id in fake._live_children(block_id):
+        block = copy.deepcopy(fake.objects[child_id])
+        children = source_tree(fake, child_id)
+        if children:
+            block[block["type"]]["children"] = children
+        blocks.append(block)
+    return blocks
+
+
+def assert_identical(fake):
+    """Every source page is migrated, with the blocks and properties main.py writes from it."""
+    target_pages = {page["id"]: page for page in iterate_paginated_api(
+        migration.notion.databases.query, database_id=migration.TARGET_DATABASE_ID)}
+    differences = {}
+    for doc in migration.query_source_pages():
+        source_id = doc["id"]
+        target_id = migration.journal.target_page(source_id)
+        assert migration.journal.is_done(source_id) and target_id in target_pages
+        diff = verifier.compare_children(
+            prepared_tree(*run(migration.prepare_blocks_for_notion, source_tree(fake, source_id))),
+            target_id, migration.list_children, verifier.PageDiff(migration.journal.pages[source_id]["substituted"]))
+        properties = verifier.changed_properties(
+            run(migration.build_properties, doc), target_pages[target_id]["properties"])
+        if diff or properties:
+            differences[source_id] = {"properties": properties, **diff.as_dict()}
+    assert not differences
+
+
+@pytest.mark.parametrize("depth", [2, 6])
+def test_migrated_pages_match_their_source(workspace, depth):
+    seed(workspace, 8, depth)
+    written = run(migration.migrate, migration.query_source_pages())
+    assert len(written) == 8
+    assert_identical(workspace)
+
+
+def test_rejected_blocks_are_narrowed_down(workspace):
+    seed(workspace, 0, 2)
+    child_page = {"object": "block", "type": "child_page", "child_page": {"title": "Sub page"}}
+    source_id = add_page(workspace, "Rejected blocks", [
+        paragraph("before"),
+        toggle("toggle", [paragraph("ok 1"), child_page, paragraph("ok 2"),
+                          toggle("inner", [paragraph("ok 3"), child_page])]),
+        child_page,
+        paragraph("after"),
+    ])
+    run(migration.migrate, migration.query_source_pages())
+    # Only the child pages are replaced, their siblings are all written
+    assert sorted(migration.journal.pages[source_id]["substituted"]) == [(1, 1), (1, 3, 1), (2,)]
+    assert_identical(workspace)
+
+
+def first_text(blocks):
+    content = blocks[0].get(blocks[0].get("type") or next(iter(blocks[0])), {})
+    return plain_text(content.get("rich_text", [])) if isinstance(content, dict) else ""
+
+
+# A number fails that append call: the first ones write the top level of the pages, the later ones
+# their deep groups. A text fails the append of the batch it starts, here the middle of a long page.
+@pytest.mark.parametrize("failed_call", [5, 40, "p100"])
+def test_interrupted_page_is_resumed(workspace, monkeypatch, failed_call):
+    seed(workspace, 3, 6)
+    add_page(workspace, "Long page", [paragraph(f"p{i}") for i in range(300)])
+    # Patched on the class, so the client still wraps it like the other endpoints
+    endpoint = type(workspace.blocks.children)
+    append = endpoint.append
+    calls = []
+    failed = []
+
+    def fail_once(self, **kwargs):
+        calls.append(first_text(kwargs["children"]))
+        if not failed and failed_call in (len(calls), calls[-1]):
+            failed.append(kwargs["block_id"])
+            # Not retried for an append, the server may have written it
+            raise APIResponseError(code="internal_server_error", status=500, message="Injected failure",
+                                   headers=httpx.Headers(), raw_body_text="")
+        return append(self, **kwargs)
+
+    monkeypatch.setattr(endpoint, "append", fail_once)
+    written = run(migration.migrate, migration.query_source_pages())
+    assert len(written) == 3 and len(migration.incomplete_pages) == 1
+    assert not migration.journal.is_done(migration.incomplete_pages[0])
+
+    written = run(migration.migrate, migration.query_source_pages())
+    # Only the incomplete page is written again, from the failed append on
+    assert len(written) == 1
+    assert len(workspace._live_children(migration.TARGET_DATABASE_ID)) == 4
+    assert_identical(workspace)
+
+
+def test_hosted_files_are_copied(workspace, monkeypatch):
+    # Small files stand for the large ones, sent in parts
+    monkeypatch.setattr(rehost, "MAX_SINGLE_PART_BYTES", 1000)
+    monkeypatch.setattr(rehost, "PART_BYTES", 400)
+    monkeypatch.setattr(fake_notion, "MIN_UPLOAD_PART_BYTES", 400)
+    files = {"/a.png": b"a" * 100, "/same_as_a.png": b"a" * 100, "/b.pdf": bytes(range(256)) * 5}
+
+    def serve(request):
+        if request.url.path not in files:
+            return httpx.Response(404)
+        return httpx.Response(200, content=files[request.url.path])
+
+    rehoster = FileRehoster(migration.notion, http=httpx.Client(transport=httpx.MockTransport(serve)))
+    monkeypatch.setattr(migration, "rehoster", rehoster)
+    seed(workspace, 0, 2)
+    source_id = add_page(workspace, "Files", [
+        hosted_file("image", "a.png"),
+        # The same source file, with another signature
+        hosted_file("image", "a.png", signature="2"),
+        # Another source file with the same content
+        hosted_file("image", "same_as_a.png"),
+        toggle("attachments", [hosted_file("pdf", "b.pdf")]),
+        hosted_file("file", "missing.bin"),
+    ])
+    run(migration.migrate, migration.query_source_pages())
+    run(rehoster.close)
+
+    assert (rehoster.uploaded, rehoster.deduplicated, rehoster.failed) == (2, 2, 1)
+    assert sorted((upload["mode"], upload["content"]) for upload in workspace.uploads.values()) == [
+        ("multi_part", files["/b.pdf"]), ("single_part", files["/a.png"])]
+    assert workspace.requests["file_uploads.send"] == 1 + 4 and workspace.requests["file_uploads.complete"] == 1
+    target = [workspace.objects[block_id] for block_id in workspace._live_children(
+        migration.journal.target_page(source_id))]
+    assert [block[block["type"]].get("type") for block in target[:3]] == ["file_upload"] * 3
+    assert len({block["image"]["file_upload"]["id"] for block in target[:3]}) == 1
+    pdf = workspace.objects[workspace._live_children(target[3]["id"])[0]]
+    assert pdf["pdf"]["file_upload"]["id"] != target[0]["image"]["file_upload"]["id"]
+    # The file that could not be downloaded keeps the warning
+    assert plain_text(target[4]["paragraph"]["rich_text"]) == FILE_WARNING
+    assert_identical(workspace)
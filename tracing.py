@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from api_metrics import current_page
+
+TRACE_PATH = "migration_trace.json"
+# Number of pages listed as the slowest ones
+TOP_PAGES = 10
+
+# Innermost span open in the current thread or task, see Tracer.span()
+current_span = ContextVar("current_span", default=None)
+
+
+def count_request():
+    """Count a request sent by the API client in every span open around it."""
+    span = current_span.get()
+    while span is not None:
+        with span["lock"]:
+            span["requests"] += 1
+        span = span["parent"]
+
+
+class Tracer:
+    """
+    Nested spans of the phases of every page, saved as Chrome trace events
+    (chrome://tracing or ui.perfetto.dev): each page is a process named after
+    it, with one row per thread that worked on it. A span records the
+    requests sent while it was open, its children's included, along with
+    the counts its phase attached to it.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.pages = {}
+        self.threads = {}
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    def name_page(self, source_id, name, page_type=None):
+        with self._lock:
+            self._page(source_id).update({"name": name, "type": page_type})
+
+    def _page(self, source_id):
+        # Process 0 holds the spans of no page, e.g. the source query
+        return self.pages.setdefault(source_id, {"pid": len(self.pages) + 1, "name": source_id, "type": None})
+
+    @contextmanager
+    def span(self, name, **args):
+        """Trace the block as a phase of the current page; yields a dict to attach counts to."""
+        span = {"name": name, "page": current_page.get(), "args": dict(args), "requests": 0,
+                "parent": current_span.get(), "lock": threading.Lock()}
+        token = current_span.set(span)
+        started = time.perf_counter()
+        try:
+            yield span["args"]
+        finally:
+            ended = time.perf_counter()
+            current_span.reset(token)
+            with self._lock:
+                thread = threading.current_thread().name
+                self.threads.setdefault(thread, len(self.threads))
+                self.spans.append({"name": name, "page": span["page"], "top": span["parent"] is None,
+                                   "thread": thread, "start": started - self._started,
+                                   "duration": ended - started, "requests": span["requests"],
+                                   "args": span["args"]})
+
+    def events(self):
+        """The spans as Chrome trace events, times in microseconds."""
+        events = []
+        with self._lock:
+            for span in self.spans:
+                page = self._page(span["page"]) if span["page"] else None
+                events.append({
+                    "name": span["name"], "cat": "phase", "ph": "X",
+                    "ts": round(span["start"] * 1e6), "dur": round(span["duration"] * 1e6),
+                    "pid": page["pid"] if page else 0, "tid": self.threads[span["thread"]],
+                    "args": {**span["args"], "requests": span["requests"], "page": span["page"]}})
+            for source_id, page in self.pages.items():
+                events.append({"name": "process_name", "ph": "M", "pid": page["pid"],
+                               "args": {"name": f"{page['name']} ({page['type']})" if page["type"] else page["name"]}})
+            for pid in {event["pid"] for event in events}:
+                for thread, tid in self.threads.items():
+                    events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                                   "args": {"name": thread}})
+        return events
+
+    def page_totals(self):
+        """Per page: name, type, time spent in its phases, requests and time of each phase."""
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                if not span["top"] or span["page"] is None:
+                    continue
+                page = self._page(span["page"])
+                total = totals.setdefault(span["page"], {
+                    "name": page["name"], "type": page["type"], "duration": 0,
+                    "requests": 0, "phases": defaultdict(float)})
+                total["duration"] += span["duration"]
+                total["requests"] += span["requests"]
+                total["phases"][span["name"]] += span["duration"]
+        return totals
+
+    def report(self):
+        """Text report: the slowest pages with their slowest phase, and the share of each phase per page type."""
+        totals = self.page_totals()
+        lines = [f"{'page':<40} {'type':<12} {'time (s)':>9} {'requests':>9}  slowest phase"]
+        for total in sorted(totals.values(), key=lambda total: total["duration"], reverse=True)[:TOP_PAGES]:
+            phase, duration = max(total["phases"].items(), key=lambda item: item[1])
+            lines.append(f"{str(total['name'])[:40]:<40} {str(total['type'])[:12]:<12} "
+                         f"{total['duration']:>9.2f} {total['requests']:>9}  {phase} ({duration:.2f} s)")
+        by_type = defaultdict(lambda: defaultdict(float))
+        for total in totals.values():
+            for phase, duration in total["phases"].items():
+                by_type[total["type"]][phase] += duration
+        for page_type, phases in sorted(by_type.items(), key=lambda item: str(item[0])):
+            spent = sum(phases.values()) or 1
+            lines.append(f"{page_type}: " + ", ".join(
+                f"{phase} {duration / spent:.0%}"
+                for phase, duration in sorted(phases.items(), key=lambda item: item[1], reverse=True)))
+        return "\n".join(lines)
+
+    def write(self, path=TRACE_PATH):
+        with open(path, "w") as trace:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, trace)
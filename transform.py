@@ -0,0 +1,308 @@
+import logging
+from collections import Counter
+from packer import MAX_BLOCKS_PER_PAGE, pack_blocks
+from preflight import fix_block
+
+MAX_CODE_BLOCK_LENGTH = 2000
+# Levels of blocks a single request can carry: a block and its children
+MAX_NESTING_DEPTH = 2
+# Blocks the API only creates together with their children
+CHILDREN_REQUIRED_TYPES = ["column_list", "table"]
+# Text of the paragraphs written in place of the files the API cannot create
+IMAGE_WARNING = "⚠️ Go fetch the image from the original doc ⚠️"
+FILE_WARNING = "⚠️ Go fetch the file from the original doc ⚠️"
+# Blocks holding a file, hosted by Notion in the source when their content type is "file"
+FILE_BLOCK_TYPES = ["image", "file", "pdf", "video", "audio"]
+
+# Rules applied to every block, in registration order: (block types, rule)
+RULES = []
+
+
+def register_rule(*block_types):
+    """
+    Register a transformation rule for the given block types, or for every
+    block if none is given. A rule is called with (block, context) and returns
+    the block to keep (the same one, modified or not, or a replacement),
+    a list of blocks to put in its place, or None to drop it.
+    The blocks it returns go through the rules registered after it.
+    """
+    def register(rule):
+        RULES.append((set(block_types), rule))
+        return rule
+    return register
+
+
+class TransformContext:
+    """
+    State of one transformation: the deep block groups extracted, the blocks
+    whose children ids are read by listing them, and counters.
+    """
+
+    def __init__(self):
+        self.deep_blocks = {}
+        self.listed_parents = set()
+        self.counts = Counter()
+
+
+def warning_paragraph(content):
+    return {"paragraph": {
+        "rich_text": [
+            {"text": {"content": content},
+             "annotations": {
+                "bold": True,
+                "italic": False,
+                "strikethrough": False,
+                "underline": True,
+                "code": False,
+                "color": "red"
+            }, }]}}
+
+
+@register_rule()
+def strip_read_only_keys(block, context):
+    # Remove parent key to create unique new object
+    block.pop('parent', None)
+    block.pop('created_time', None)
+    block.pop('created_by', None)
+    block.pop('last_edited_by', None)
+    block.pop('last_edited_time', None)
+    # remove id of blocks with children, to force creation of new block
+    if block.get("has_children"):
+        block.pop('id', None)
+    return block
+
+
+def is_attachable(content):
+    # The API writes files from an external URL or from an upload, not from a URL hosted by Notion
+    return isinstance(content, dict) and content.get("type") in ("external", "file_upload")
+
+
+@register_rule("image", "external")
+def replace_image(block, context):
+    # Images hosted by Notion and not copied to the target (see rehost.py), replace them with a warning
+    if is_attachable(block.get(block.get("type"))):
+        return block
+    context.counts["images"] += 1
+    return warning_paragraph(IMAGE_WARNING)
+
+
+@register_rule(*(block_type for block_type in FILE_BLOCK_TYPES if block_type != "image"))
+def replace_hosted_file(block, context):
+    # File blocks must point to an external URL or to an upload
+    if not is_attachable(block.get(block.get("type"))):
+        context.counts["files"] += 1
+        return warning_paragraph(FILE_WARNING)
+    return block
+
+
+@register_rule()
+def replace_link_mentions(block, context):
+    # The `link_preview` block can only be returned as part of a response. The API does not support creating or appending `link_preview` blocks.
+    # If the block is a link preview or a link mention within a rich text, replace it with a text block
+    content = block.get(block.get("type"))
+    if not isinstance(content, dict) or not content.get("rich_text"):
+        return block
+    rich_text = content.get("rich_text")
+    for index, text in enumerate(rich_text):
+        if text.get("type") == "mention":
+            mention_type = text.get("mention").get("type")
+            if mention_type == "link_preview":
+                rich_text[index] = {
+                    "text": {"content": text.get("mention").get(mention_type).get("url")}, }
+            elif mention_type == "link_mention":
+                rich_text[index] = {
+                    "text": {"content": text.get("mention").get(mention_type).get("href")}, }
+    return block
+
+
+@register_rule("link_preview", "link_mention")
+def replace_link_preview(block, context):
+    # If the block is a link preview or a link mention, replace it with a bookmark block
+    link = block.get(block.get("type"))
+    return {
+        "object": "block",
+        "type": "bookmark",
+        "bookmark": {
+            "url": link.get("url") or link.get("href")
+        }
+    }
+
+
+@register_rule("unsupported")
+def drop_unsupported(block, context):
+    context.counts["unsupported"] += 1
+    return None
+
+
+@register_rule("code")
+def split_long_code(block, context):
+    """
+    Split code blocks with a text item that exceeds MAX_CODE_BLOCK_LENGTH characters
+    into multiple sequential blocks, each holding a part of the whole code.
+    """
+    rich_text = block["code"].get("rich_text", [])
+    if not any(len(text.get("text", {}).get("content", "")) > MAX_CODE_BLOCK_LENGTH
+               for text in rich_text):
+        return block
+    content = "".join(text.get("text", {}).get("content", "") for text in rich_text)
+
+    language = block["code"].get("language", "plain text")
+    chunks = [content[i:i+MAX_CODE_BLOCK_LENGTH]
+              for i in range(0, len(content), MAX_CODE_BLOCK_LENGTH)]
+    context.counts["code_splits"] += len(chunks) - 1
+    # The original block keeps the first chunk, in the style of its first text
+    first_text = next(text for text in rich_text if "text" in text)
+    first_text["text"]["content"] = chunks[0]
+    first_text.pop("plain_text", None)
+    block["code"]["rich_text"] = [first_text]
+    blocks = [block]
+    # Create continuation blocks for remaining chunks
+    for chunk in chunks[1:]:
+        blocks.append({
+            "type": "code",
+            "object": "block",
+            "code": {
+                "rich_text": [{"type": "text", "text": {"content": chunk}}],
+                "language": language
+            }
+        })
+    return blocks
+
+
+@register_rule()
+def fix_rich_text_limits(block, context):
+    # Texts over the API limits would fail the whole request, see preflight.fix_block
+    fixes = []
+    blocks = fix_block(block, fixes)
+    context.counts["preflight_fixes"] += len(fixes)
+    for fix in fixes:
+        logging.info(f"Pre-flight: {fix}")
+    return blocks
+
+
+def apply_rules(block, context, first_rule=0):
+    """Run block through the rules from first_rule on, returning the blocks it became."""
+    for position in range(first_rule, len(RULES)):
+        block_types, rule = RULES[position]
+        if block_types and block.get("type") not in block_types:
+            continue
+        result = rule(block, context)
+        if result is None:
+            return []
+        if isinstance(result, list):
+            blocks = []
+            for item in result:
+                blocks.extend(apply_rules(item, context, position + 1))
+            return blocks
+        block = result
+    return [block]
+
+
+def has_inline_children(block):
+    content = block.get(block.get("type"))
+    return isinstance(content, dict) and bool(content.get("children"))
+
+
+def needs_id(path, context):
+    """True if the block at path must be known by id to append its children later."""
+    return path in context.deep_blocks or path in context.listed_parents
+
+
+def place_children(block, children, path, context):
+    """
+    Decide how the transformed children of a block are written. A request carries
+    at most MAX_NESTING_DEPTH levels of blocks and only returns the ids of its
+    top level, so:
+    - children that are all leaves stay inline, created along with the block
+    - blocks that cannot be created without children (column_list, table) keep
+      them inline, minus the children of those children, which become deep
+      groups: their parents ids are read by listing the block (listed_parents)
+    - otherwise the children are extracted to deep_blocks under the path of the
+      block, and appended once the id of the block is known
+    Lists longer than a request allows are always completed by a deep group.
+    """
+    block_type = block.get("type")
+    content = block[block_type]
+    leaves = not any(has_inline_children(child) or needs_id(path + (i,), context)
+                     for i, child in enumerate(children))
+    if block_type in CHILDREN_REQUIRED_TYPES:
+        content["children"] = children[:MAX_BLOCKS_PER_PAGE]
+        if len(children) > MAX_BLOCKS_PER_PAGE:
+            context.deep_blocks[path] = children[MAX_BLOCKS_PER_PAGE:]
+        if not leaves:
+            for i, child in enumerate(content["children"]):
+                if has_inline_children(child):
+                    context.deep_blocks[path + (i,)] = child[child.get("type")]["children"]
+                if child.get("has_children"):
+                    # Columns are created empty, their content is appended later
+                    child[child.get("type")]["children"] = []
+            context.listed_parents.add(path)
+            logging.info(
+                f"Preserving minimal valid structure for {block_type} at path {list(path)}")
+    elif leaves and len(children) <= MAX_BLOCKS_PER_PAGE:
+        content["children"] = children
+    else:
+        context.deep_blocks[path] = children
+        # Remove children from the block for initial creation
+        del content["children"]
+        logging.info(
+            f"Extracted {len(children)} nested blocks at path {list(path)} for later appending")
+
+
+def transform_blocks(blocks, context, path=()):
+    """
+    Transform a block tree in a single traversal: every block goes through the
+    registered rules, then its children are transformed in the same walk and
+    placed either inline or in context.deep_blocks (see place_children), at any depth.
+    Blocks are modified in place, paths are positions in the transformed tree.
+    """
+    result = []
+    for block in blocks:
+        if not isinstance(block, dict):
+            result.append(block)
+            continue
+        for transformed in apply_rules(block, context):
+            block_path = path + (len(result),)
+            result.append(transformed)
+            block_type = transformed.get("type")
+            content = transformed.get(block_type)
+            if not transformed.get("has_children") or not isinstance(content, dict) or "children" not in content:
+                continue
+            children = transform_blocks(content["children"], context, block_path)
+            place_children(transformed, children, block_path, context)
+    return result
+
+
+def prepare_blocks_for_notion(blocks):
+    """
+    Prepare blocks for Notion API by handling validation constraints, in a single pass:
+    - Sanitizes blocks and replaces the ones the API cannot create
+    - Filters out unsupported blocks
+    - Splits code blocks exceeding MAX_CODE_BLOCK_LENGTH characters
+    - Extracts blocks that cannot be sent inline, at any depth, for later appending
+    - Returns prepared blocks for initial page creation and data for later appending
+    The initial blocks stop before the first block whose id is needed later,
+    since the page creation does not return the ids of the blocks it creates.
+    """
+    if not isinstance(blocks, list):
+        return blocks, [], {}
+
+    context = TransformContext()
+    prepared_blocks = transform_blocks(blocks, context)
+    if context.counts["unsupported"] > 0:
+        logging.info(
+            f"Removed {context.counts['unsupported']} unsupported block(s)")
+        print(f"Removed {context.counts['unsupported']} unsupported block(s)")
+    if context.counts["preflight_fixes"] > 0:
+        print(f"Rewrote {context.counts['preflight_fixes']} text(s) over the API limits")
+
+    # Then separate blocks for initial page creation (as many as a request can carry)
+    # from excess blocks that will be appended later
+    initial_blocks = next(pack_blocks(prepared_blocks), (0, []))[1]
+    for i in range(len(initial_blocks)):
+        if needs_id((i,), context):
+            initial_blocks = initial_blocks[:i]
+            break
+    excess_blocks = prepared_blocks[len(initial_blocks):]
+
+    return initial_blocks, excess_blocks, context.deep_blocks
@@ -0,0 +1,135 @@
+import difflib
+import hashlib
+import json
+import os
+
+from fingerprint import block_type_of, hosted_file_kind, normalize_content, normalize_properties
+
+VERIFY_REPORT_PATH = "verify_report.json"
+# Pages found identical, with the last_edited_time of both sides, skipped by the next verification
+VERIFY_STATE_PATH = "verify_state.json"
+# Number of pages verified at the same time
+VERIFY_WORKERS = 4
+# Differences printed per page, the report has all of them
+MAX_LISTED_DIFFERENCES = 5
+
+
+def shallow_key(block):
+    """
+    Hash of a block without its children, ids and timestamps left out.
+    A file hosted by Notion and the warning written in its place have the
+    same key, see hosted_file_kind.
+    """
+    block_type = block_type_of(block)
+    content = block.get(block_type)
+    kind = hosted_file_kind(block_type, content)
+    if kind:
+        return kind
+    return hashlib.sha256(json.dumps(
+        [block_type, normalize_content(block_type, content)], sort_keys=True, ensure_ascii=False
+    ).encode()).hexdigest()
+
+
+class PageDiff:
+    """
+    Differences between the expected tree of a page and its target, as paths
+    of blocks in the expected tree, but for the extra blocks: their last
+    index is their position among the children of the target parent.
+    """
+
+    def __init__(self, substituted=None):
+        self.missing = []
+        self.extra = []
+        self.changed = []
+        self.substituted = []
+        self.known_substitutions = substituted or {}
+
+    def __bool__(self):
+        return bool(self.missing or self.extra or self.changed)
+
+    def as_dict(self):
+        return {key: [list(path) for path in getattr(self, key)]
+                for key in ["missing", "extra", "changed", "substituted"]}
+
+
+def compare_children(expected, parent_id, list_children, diff, path=()):
+    """
+    Compare the expected children of a block with the children of parent_id
+    in the target, level by level: siblings are aligned on their shallow_key,
+    and only the children of blocks that match are listed and compared in
+    turn, so a subtree that is missing or different is not fetched.
+    Blocks the journal records as replaced with a placeholder are expected
+    to differ.
+    """
+    target = list_children(parent_id)
+    matcher = difflib.SequenceMatcher(
+        None, [shallow_key(block) for block in expected], [shallow_key(block) for block in target],
+        autojunk=False)
+    matched = []
+    for tag, expected_start, expected_end, target_start, target_end in matcher.get_opcodes():
+        if tag == "equal":
+            matched.extend(zip(range(expected_start, expected_end), range(target_start, target_end)))
+            continue
+        paired = min(expected_end - expected_start, target_end - target_start) if tag == "replace" else 0
+        for i in range(expected_start, expected_start + paired):
+            j = target_start + i - expected_start
+            if path + (i,) in diff.known_substitutions:
+                diff.substituted.append(path + (i,))
+            elif block_type_of(expected[i]) == block_type_of(target[j]):
+                diff.changed.append(path + (i,))
+                matched.append((i, j))
+            else:
+                diff.missing.append(path + (i,))
+                diff.extra.append(path + (j,))
+        for i in range(expected_start + paired, expected_end):
+            if path + (i,) in diff.known_substitutions:
+                diff.substituted.append(path + (i,))
+            else:
+                diff.missing.append(path + (i,))
+        diff.extra.extend(path + (j,) for j in range(target_start + paired, target_end))
+    for i, j in matched:
+        content = expected[i].get(block_type_of(expected[i]))
+        children = (content.get("children") or []) if isinstance(content, dict) else []
+        if children or target[j].get("has_children"):
+            compare_children(children, target[j].get("id"), list_children, diff, path + (i,))
+    return diff
+
+
+def changed_properties(properties, target_properties):
+    """Names of the properties written to the target page whose value differs from it."""
+    expected = normalize_properties(properties)
+    actual = normalize_properties({name: target_properties.get(name, {}) for name in properties})
+    return sorted(name for name in set(expected) | set(actual) if expected.get(name) != actual.get(name))
+
+
+def load_state(path=VERIFY_STATE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as state:
+        return json.load(state)
+
+
+def save_state(state, path=VERIFY_STATE_PATH):
+    with open(path, "w") as output:
+        json.dump(state, output)
+
+
+def report(results):
+    """Text report: the pages that differ from their source, and the count of pages per status."""
+    lines = []
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        if result["status"] == "identical" or result["status"] == "unchanged":
+            continue
+        line = f"{result['status']}: {result.get('name') or result['source']}"
+        if result["status"] == "different":
+            line += (f" ({len(result['missing'])} missing, {len(result['extra'])} extra, "
+                     f"{len(result['changed'])} changed blocks")
+            line += f", properties {', '.join(result['properties'])})" if result["properties"] else ")"
+            for key in ["missing", "extra", "changed"]:
+                if result[key]:
+                    line += f"\n  {key}: {result[key][:MAX_LISTED_DIFFERENCES]}"
+        lines.append(line)
+    lines.append("Verified pages: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return "\n".join(lines)